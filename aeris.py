@@ -6,15 +6,15 @@ Copyright (C) 2019,2020,2021 Robert Paauwe
 
 import udi_interface
 import sys
-import time
 from nodes import aeris
 from nodes import aeris_daily
+from nodes import aeris_conditions
 
 LOGGER = udi_interface.LOGGER
 
 if __name__ == "__main__":
     try:
-        polyglot = udi_interface.Interface([aeris.Controller, aeris_daily.DailyNode])
+        polyglot = udi_interface.Interface([aeris.Controller, aeris_daily.DailyNode, aeris_conditions.ConditionsNode])
         polyglot.start('2.0.9')
         control = aeris.Controller(polyglot, 'controller', 'controller', 'AERIS Weather')
         polyglot.runForever()
@@ -5,21 +5,37 @@ Copyright (C) 2019,2020,2021 Robert Paauwe
 """
 
 import udi_interface
-import sys
+import os
 import time
-import datetime
-import requests
-import socket
-import math
-import re
-import json
+import hashlib
+import threading
 #import node_funcs
 from nodes import aeris_daily
+from nodes import aeris_conditions
 from nodes import query
+from nodes import snapshot
+from nodes import prefetch
 
 LOGGER = udi_interface.LOGGER
 Custom = udi_interface.Custom
 
+# Hash of the files sent to Polyglot by updateProfile() and
+# setCustomParamsDoc()
+def profile_hash(paths=('profile', 'POLYGLOT_CONFIG.md')):
+    digest = hashlib.sha256()
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(d, f) for (d, dirs, names) in os.walk(path) for f in names)
+        for name in files:
+            try:
+                with open(name, 'rb') as f:
+                    digest.update(name.encode())
+                    digest.update(f.read())
+            except (IOError, OSError):
+                pass
+    return digest.hexdigest()
+
 class Controller(udi_interface.Node):
     id = 'weather'
     def __init__(self, polyglot, primary, address, name):
@@ -30,15 +46,33 @@ class Controller(udi_interface.Node):
         self.address = address
         self.primary = primary
         self.configured = False
-        self.node_added_count = 0
+        self.config_ready = threading.Event()
+        self.config_done = threading.Event()
+        self.node_added = threading.Condition()
+        self.added = set()
+        self.stale = False
+        self.saved = 0
+        self.snapshot = snapshot.Snapshot()
 
         self.Notices = Custom(polyglot, 'notices')
         self.Parameters = Custom(polyglot, 'customparams')
+        self.CustomData = Custom(polyglot, 'customdata')
 
         self.q = query.queries(self.poly)
+        self.q.register_drivers('observations', self.drivers)
+        self.q.register_drivers('forecasts', aeris_daily.DailyNode.drivers)
+
+        # AERIS requests are made by the worker thread, poll and query
+        # only publish what it has fetched.
+        self.worker = prefetch.Prefetcher()
+        self.worker.add('conditions', self.fetch_conditions, 200)
+        self.worker.add('forecasts', self.fetch_forecasts, 900)
+        self.worker.on_refresh = self.refreshed
 
         self.poly.subscribe(self.poly.CONFIG, self.configHandler)
         self.poly.subscribe(self.poly.CUSTOMPARAMS, self.parameterHandler)
+        self.poly.subscribe(self.poly.CUSTOMDATA, self.CustomData.load)
+        self.poly.subscribe(self.poly.CONFIGDONE, self.configDoneHandler)
         self.poly.subscribe(self.poly.START, self.start, address)
         self.poly.subscribe(self.poly.POLL, self.poll)
         self.poly.subscribe(self.poly.ADDNODEDONE, self.nodeHandler)
@@ -70,13 +104,17 @@ class Controller(udi_interface.Node):
         else:
             LOGGER.error('Client Secret is missing.')
 
+        # Location can be a ; separated list of locations
         if self.Parameters['Location'] is not None:
-            if 'PWS' in self.Parameters['Location']:
-                validLoc = True
-            elif len(self.Parameters['Location']) > 2:
-                validLoc = True
-            else:
-                LOGGER.debug('Location {} invalid.'.format(self.Parameters['Location']))
+            validLoc = len(self.locations()) > 0
+            for location in self.locations():
+                if 'PWS' in location:
+                    continue
+                elif len(location) > 2:
+                    continue
+                else:
+                    validLoc = False
+                    LOGGER.debug('Location {} invalid.'.format(location))
         else:
             LOGGER.error('Client Secret is missing.')
 
@@ -85,20 +123,23 @@ class Controller(udi_interface.Node):
 
         if validCli and validSec and validLoc:
             self.q.units = self.Parameters['Units']
-            self.q.location = self.Parameters['Location']
             self.q.client_id = self.Parameters['ClientID']
             self.q.client_secret = self.Parameters['ClientSecret']
             self.q.plant_type = self.Parameters['Plant Type']
             self.q.days = self.Parameters['Forecast Days']
-            self.q.elevation = self.Parameters['Elevation']
+            self.q.set_locations(self.locations(), str(self.Parameters['Elevation']).split(';'))
+            self.q.quota.configure(self.q.client_id, self.limit('Requests Per Minute'), self.limit('Requests Per Day'))
+            self.q.configure_requests(self.batch(), self.threads())
             self.q.configured = True
             self.configured = True
+            self.config_ready.set()
 
-            # check if number of forecast days has changed
-            if self.Parameters.isChanged('Forecast Days'):
+            # check if number of forecast days or locations has changed
+            if self.Parameters.isChanged('Forecast Days') or self.Parameters.isChanged('Location'):
                 LOGGER.info('CALLING DISCOVERY from parameter Handler')
                 self.discover()
-                self.q.query_forecasts(self.Parameters['Units'], True)
+                if self.worker.running:
+                    self.worker.wake(True)
         else:
             if not validCli:
                 LOGGER.warning('Client ID must be set')
@@ -110,6 +151,33 @@ class Controller(udi_interface.Node):
                 LOGGER.warning('Location must be set')
                 self.Notices['loc'] = 'AERIS location must be configured.'
 
+    def locations(self):
+        return [l.strip() for l in self.Parameters['Location'].split(';') if l.strip() != '']
+
+    # Batch Requests, on unless set to false
+    def batch(self):
+        return str(self.Parameters['Batch Requests']).strip().lower() not in ('false', 'no', 'off', '0')
+
+    # Request Threads, connections and threads used when not batching
+    def threads(self):
+        try:
+            return max(1, int(self.Parameters['Request Threads'] or 4))
+        except ValueError:
+            LOGGER.warning('Request Threads {} invalid, using 4.'.format(self.Parameters['Request Threads']))
+            return 4
+
+    # Request limit parameters, 0 (no limit) if not set
+    def limit(self, name):
+        try:
+            return int(self.Parameters[name] or 0)
+        except ValueError:
+            LOGGER.warning('{} {} invalid, not limiting requests.'.format(name, self.Parameters[name]))
+            return 0
+
+    # Polyglot has sent all the custom data and parameters
+    def configDoneHandler(self):
+        self.config_done.set()
+
     def configHandler(self, config):
         # at this time the interface should have all the nodes
         # included from the database.  Here's where we could 
@@ -119,78 +187,202 @@ class Controller(udi_interface.Node):
         for n in nodes:
             LOGGER.info('Found node {} = {}'.format(n, nodes[n]))
 
+        # Retries for a poll's requests need to finish before the next poll
+        if 'shortPoll' in config:
+            self.q.poll_interval = int(config['shortPoll'])
+            self.worker.set_interval('conditions', int(config['shortPoll']))
+        if 'longPoll' in config:
+            self.worker.set_interval('forecasts', int(config['longPoll']))
+
     def nodeHandler(self, data):
-        self.node_added_count += 1
+        with self.node_added:
+            self.added.add(data['address'])
+            self.node_added.notify_all()
+
+    # Wait for Polyglot to acknowledge the nodes were added, returns the
+    # addresses of any that weren't.
+    def wait_for_nodes(self, addresses, timeout=30):
+        with self.node_added:
+            self.node_added.wait_for(lambda: self.added.issuperset(addresses), timeout)
+            missing = set(addresses) - self.added
+
+        for address in sorted(missing):
+            LOGGER.warning('Timed out waiting for node {} to be added'.format(address))
+        return missing
 
     def start(self):
         LOGGER.info('Starting node server')
-        self.poly.updateProfile()
-        self.poly.setCustomParamsDoc()
 
-        while not self.configured:
-            time.sleep(10)
+        # Show the values saved before the restart until we have new data
+        self.restore(self)
+
+        while not self.config_ready.wait(60):
+            LOGGER.info('Waiting for the node server to be configured')
+
+        # The saved hash is only there once the custom data has loaded
+        if not self.config_done.wait(60):
+            LOGGER.warning('Custom data not loaded, updating profile')
+
+        # Only send the profile and parameter docs when they've changed
+        digest = profile_hash()
+        if self.CustomData['profile_hash'] != digest:
+            LOGGER.info('Profile changed, updating')
+            self.poly.updateProfile()
+            self.poly.setCustomParamsDoc()
+            self.CustomData['profile_hash'] = digest
 
         LOGGER.critical('CALLING DISCOVERY from start')
         self.discover()
 
+        for node in self.site_nodes():
+            self.restore(node)
+
         # Do an initial query to get filled in as soon as possible
-        self.q.query_conditions(self.address, self.Parameters['Units'], True)
-        self.q.query_forecasts(self.Parameters['Units'], True)
+        self.q.query_all(self.address, self.Parameters['Units'], True)
+        self.update_status()
+        self.worker.start()
 
         LOGGER.info('Node server started')
 
+    # Runs on the worker thread
+    def fetch_conditions(self, force, refresh):
+        self.q.collect_conditions(self.address, self.Parameters['Units'], force, refresh)
+
+    def fetch_forecasts(self, force, refresh):
+        self.q.collect_forecasts(self.Parameters['Units'], force, refresh)
+
+    # Called by the worker when the update asked for by wake() is done
+    def refreshed(self):
+        self.q.publish(False)
+        self.update_status()
+
     def poll(self, pollType):
-        if 'shortPoll' in pollType:
-            self.q.query_conditions(self.address, self.Parameters['Units'], False)
-        else:
-            self.q.query_forecasts(self.Parameters['Units'], False)
+        self.q.publish(False)
+        self.update_status()
 
+    # Report everything we have now and have the worker get new data,
+    # a response still in the cache is used.
     def query(self):
-        self.q.query_conditions(self.address, self.Parameters['Units'], True)
-        self.q.query_forecasts(self.Parameters['Units'], True)
+        self.q.publish(True)
+        self.update_status()
+        self.worker.wake()
+
+    # Publish the driver values saved for a node
+    def restore(self, node):
+        if node is None:
+            return
+
+        saved = self.snapshot.load(node.address)
+        if len(saved) == 0:
+            return
+
+        LOGGER.info('Restoring {} saved values for {}, {} seconds old'.format(len(saved), node.address, int(time.time() - min(s[3] for s in saved))))
+        self.q.publisher.begin(node)
+        try:
+            for (driver, value, uom, updated) in saved:
+                self.q.publisher.set(node, driver, value, uom, True)
+        finally:
+            self.q.publisher.flush(node)
+
+        self.stale = True
+        self.setDriver('ST', 3, True, False, 25)
+
+    # Save the driver values when a poll got new data from AERIS
+    def save_state(self):
+        if self.q.updated <= self.saved:
+            return
+
+        self.snapshot.save([self] + self.site_nodes())
+        self.saved = self.q.updated
+
+    # The conditions and forecast nodes of all the locations
+    def site_nodes(self):
+        nodes = []
+        for site in self.q.sites:
+            if site.index > 0:
+                nodes.append(self.poly.getNode(site.address))
+            for day in range(0, int(self.Parameters['Forecast Days'])):
+                nodes.append(self.poly.getNode(site.forecast_address(day)))
+        return nodes
+
+    # ST is 1 when online, 2 when AERIS requests are failing and the
+    # drivers are showing the last good data and 3 when they're still
+    # showing the values saved before a restart.
+    def update_status(self):
+        if self.q.updated > 0:
+            self.stale = False
+            self.save_state()
+
+        if self.q.degraded():
+            self.setDriver('ST', 2, True, False, 25)
+        elif self.stale:
+            self.setDriver('ST', 3, True, False, 25)
+        else:
+            self.setDriver('ST', 1, True, False, 25)
 
     def discover(self, *args, **kwargs):
         # Create any additional nodes here
         LOGGER.info("In Discovery...")
 
-        node_count = 1
         num_days = int(self.Parameters['Forecast Days'])
-        if num_days < 7:
-            # delete any extra days
-            for day in range(num_days, 7):
-                address = 'forecast_' + str(day)
-                try:
-                    if self.poly.getNode(address):
-                        self.poly.delNode(address)
-                except:
-                    LOGGER.debug('Failed to delete node ' + address)
-
-        for day in range(0,num_days):
-            address = 'forecast_' + str(day)
-            title = 'Forecast ' + str(day)
+
+        # The nodes for each location: a conditions node for all but the
+        # first (that's the controller) and its forecast nodes
+        wanted = {}
+        for site in self.q.sites:
+            if site.index > 0:
+                wanted[site.address] = site.location + ' Conditions'
+            for day in range(0, num_days):
+                title = 'Forecast ' + str(day)
+                if site.index > 0:
+                    title = site.location + ' ' + title
+                wanted[site.forecast_address(day)] = title
+
+        # delete any extra days and the nodes of removed locations
+        extra = set(a for a in self.poly.getNodes() if a.startswith('forecast_') or a.startswith('cond_'))
+        for site in self.q.sites:
+            extra.update(site.forecast_address(day) for day in range(num_days, 7))
+        for address in sorted(extra):
+            if address in wanted:
+                continue
+            try:
+                if self.poly.getNode(address):
+                    self.poly.delNode(address)
+                    self.q.publisher.forget(address)
+                    self.q.results.forget(address)
+                    self.snapshot.forget(address)
+                    with self.node_added:
+                        self.added.discard(address)
+            except:
+                LOGGER.debug('Failed to delete node ' + address)
+
+        # Add all the new nodes and then wait for them all to be created
+        added = []
+        for address in wanted:
+            title = wanted[address]
             try:
                 if self.poly.getNode(address) is None:
-                    LOGGER.info('Creating forecast node {} {}'.format(address,title))
-                    node = aeris_daily.DailyNode(self.poly, self.address, address, title, self.Parameters['Units'])
-                    node.private = 'private data for ' + address
-                    node.plant_type = self.Parameters['Plant Type']
-                    node.elevation = self.Parameters['Elevation']
-
-                    LOGGER.debug('Adding forecast node {}'.format(title))
-                    node_count += 1
+                    LOGGER.info('Creating node {} {}'.format(address,title))
+                    if address.startswith('cond_'):
+                        node = aeris_conditions.ConditionsNode(self.poly, self.address, address, title)
+                    else:
+                        node = aeris_daily.DailyNode(self.poly, self.address, address, title, self.Parameters['Units'])
+                        node.private = 'private data for ' + address
+
+                    LOGGER.debug('Adding node {}'.format(title))
                     self.poly.addNode(node)
-
-                    # Wait for node to be created
-                    while self.node_added_count < node_count:
-                        time.sleep(2)
+                    added.append(address)
                 else:
-                    node_count += 1
                     LOGGER.info('Node {} already exists, skipping'.format(address))
 
             except Exception as e:
-                LOGGER.error('Failed to create forecast node {}: {}'.format(address, e))
+                LOGGER.error('Failed to create node {}: {}'.format(address, e))
                 LOGGER.error('  -> {}'.format(e))
 
+        if len(added) > 0:
+            missing = self.wait_for_nodes(added)
+            LOGGER.info('Added {} of {} nodes'.format(len(added) - len(missing), len(added)))
+
 
     # Delete the node server from Polyglot
     def delete(self):
@@ -198,6 +390,8 @@ class Controller(udi_interface.Node):
 
     def stop(self):
         LOGGER.info('Stopping node server')
+        self.worker.stop()
+        self.q.close()
 
     def remove_notices_all(self, command):
         self.Notices.clear()
@@ -210,7 +404,7 @@ class Controller(udi_interface.Node):
     # For this node server, all of the info is available in the single
     # controller node.
     drivers = [
-            {'driver': 'ST', 'value': 1, 'uom': 2},   # node server status
+            {'driver': 'ST', 'value': 1, 'uom': 25},  # node server status
             {'driver': 'CLITEMP', 'value': 0, 'uom': 4},   # temperature
             {'driver': 'CLIHUM', 'value': 0, 'uom': 22},   # humidity
             {'driver': 'DEWPT', 'value': 0, 'uom': 4},     # dewpoint
@@ -230,6 +424,11 @@ class Controller(udi_interface.Node):
             {'driver': 'DISTANC', 'value': 0, 'uom': 83},  # visibility
             {'driver': 'SOLRAD', 'value': 0, 'uom': 74},   # solar radiataion
             {'driver': 'UV', 'value': 0, 'uom': 71},       # uv index
+            {'driver': 'ETO', 'value': 0, 'uom': 106},     # ETo so far today
+            {'driver': 'GV3', 'value': 1, 'uom': 25},      # pressure trend
+            {'driver': 'GV4', 'value': 0, 'uom': 4},       # 24 hour high temp
+            {'driver': 'GV5', 'value': 0, 'uom': 4},       # 24 hour low temp
+            {'driver': 'GV6', 'value': 0, 'uom': 32},      # 24 hour max gust
             ]
 
 
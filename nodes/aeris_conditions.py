@@ -0,0 +1,46 @@
+
+# Node definition for the current conditions at an additional location
+
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+class ConditionsNode(udi_interface.Node):
+    id = 'conditions'
+    drivers = [
+            {'driver': 'CLITEMP', 'value': 0, 'uom': 4},   # temperature
+            {'driver': 'CLIHUM', 'value': 0, 'uom': 22},   # humidity
+            {'driver': 'DEWPT', 'value': 0, 'uom': 4},     # dewpoint
+            {'driver': 'BARPRES', 'value': 0, 'uom': 117}, # pressure
+            {'driver': 'WINDDIR', 'value': 0, 'uom': 76},  # direction
+            {'driver': 'SPEED', 'value': 0, 'uom': 32},    # wind speed
+            {'driver': 'GUST', 'value': 0, 'uom': 32},     # gust speed
+            {'driver': 'GV2', 'value': 0, 'uom': 4},       # feels like
+            {'driver': 'HEATIX', 'value': 0, 'uom': 4},    # heat index
+            {'driver': 'WINDCH', 'value': 0, 'uom': 4},    # wind chill
+            {'driver': 'PRECIP', 'value': 0, 'uom': 82},   # rain
+            {'driver': 'GV15', 'value': 0, 'uom': 82},     # snow depth
+            {'driver': 'GV11', 'value': 0, 'uom': 25},     # climate coverage
+            {'driver': 'GV12', 'value': 0, 'uom': 25},     # climate intensity
+            {'driver': 'GV13', 'value': 0, 'uom': 25},     # climate conditions
+            {'driver': 'GV14', 'value': 0, 'uom': 22},     # cloud conditions
+            {'driver': 'DISTANC', 'value': 0, 'uom': 83},  # visibility
+            {'driver': 'SOLRAD', 'value': 0, 'uom': 74},   # solar radiataion
+            {'driver': 'UV', 'value': 0, 'uom': 71},       # uv index
+            {'driver': 'ETO', 'value': 0, 'uom': 106},     # ETo so far today
+            {'driver': 'GV3', 'value': 1, 'uom': 25},      # pressure trend
+            {'driver': 'GV4', 'value': 0, 'uom': 4},       # 24 hour high temp
+            {'driver': 'GV5', 'value': 0, 'uom': 4},       # 24 hour low temp
+            {'driver': 'GV6', 'value': 0, 'uom': 32},      # 24 hour max gust
+            ]
+
+    # All the locations are fetched together, so have the controller
+    # query them.
+    def query(self, command=None):
+        controller = self.poly.getNode(self.primary)
+        if controller is not None:
+            controller.query()
+
+    commands = {
+            'QUERY': query,
+            }
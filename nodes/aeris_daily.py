@@ -1,11 +1,6 @@
 # Node definition for a daily forecast node
 
 import udi_interface
-import json
-import time
-import datetime
-from nodes import et3
-from nodes import query
 
 LOGGER = udi_interface.LOGGER
 
@@ -37,14 +32,7 @@ class DailyNode(udi_interface.Node):
     def __init__(self, polyglot, primary, address, name, units):
         super(DailyNode, self).__init__(polyglot, primary, address, name)
 
-        self.elevation = 0
-        self.plant_type = 0.23
         self.units = units
-        self.min_humidity = 0
-        self.max_humidity = 0
-
-    def mm2inch(self, mm):
-        return round(mm/25.4, 2)
 
     def getDriverValue(self, driver):
         for d in self.drivers:
@@ -52,50 +40,3 @@ class DailyNode(udi_interface.Node):
                 return d['value']
         LOGGER.error('{} not found in drivers array'.format(driver))
         return -1
-
-    """
-      Elevation - set at init
-      plant type - set at init
-
-      temperature min/max - available from drivers GV1/GV0
-      windspeed - available from drivers (SPEED)
-      humidity min/max -- ??? In data, but not in drivers
-    """
-
-    def set_ETo(self, epoch, latitude, force):
-        # Calculate ETo
-        #  Temp is in degree C and windspeed is in m/s, we may need to
-        #  convert these.
-        J = datetime.datetime.fromtimestamp(epoch).timetuple().tm_yday
-
-        Tmin = self.getDriverValue('GV1')
-        Tmax = self.getDriverValue('GV0')
-        Ws = self.getDriverValue('SPEED')
-        if self.units != 'metric':
-            LOGGER.info('Conversion of temperature/wind speed required')
-            Tmin = et3.FtoC(Tmin)
-            Tmax = et3.FtoC(Tmax)
-            Ws = et3.mph2ms(Ws)
-        else:
-            Ws = et3.kph2ms(Ws)
-
-        #et0 = et3.evapotranspriation(Tmax, Tmin, None, Ws, float(self.elevation), self.max_humidity, self.min_humidity, latitude, float(self.plant_type), J)
-
-        et3.tMin = Tmin
-        et3.tMax = Tmax
-        et3.julianDay = datetime.datetime.fromtimestamp(epoch).timetuple().tm_yday
-        et3.windSpeed = Ws
-        et3.elevation = float(self.elevation)
-        et3.hMin = self.min_humidity
-        et3.hMax = self.max_humidity
-        et3.latitude = latitude
-        et3.plantType = float(self.plant_type)
-        et0 = et3.get_et0()
-
-        # et0 is in mm/hr.  If the user wants imperial or uk units, it needs to be converted.
-        if self.units == 'imperial' or self.units == 'uk':
-            et0 = self.mm2inch(et0)
-        
-        wmap = query.WeatherData(self.units)
-        self.setDriver('ETO', et0, True, force, wmap.uom('ETO'))
-        LOGGER.info('ETo = {}'.format(et0))
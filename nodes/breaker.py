@@ -0,0 +1,70 @@
+"""
+Circuit breaker for the AERIS requests.
+
+After max_failures consecutive failed fetches the breaker opens and no
+requests are made for cooldown seconds.  When the cool down is over a
+single probe request is allowed (half open).  If it works the breaker
+closes and normal polling resumes, if not it opens again.
+"""
+import time
+import threading
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitBreaker(object):
+    def __init__(self, max_failures=3, cooldown=300):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN and time.time() - self.opened >= self.cooldown:
+                LOGGER.info('Circuit breaker half open, sending probe request')
+                self.state = HALF_OPEN
+                self.probing = False
+
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+
+            return False
+
+    # The request allowed by allow() wasn't made after all
+    def cancel(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+
+    def success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                LOGGER.info('Circuit breaker closed, AERIS requests are working again')
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.max_failures:
+                if self.state != OPEN:
+                    LOGGER.warning('Circuit breaker open after {} failures, pausing requests for {} seconds'.format(self.failures, self.cooldown))
+                self.state = OPEN
+                self.opened = time.time()
+                self.probing = False
+
+    def is_open(self):
+        return self.state != CLOSED
@@ -0,0 +1,55 @@
+"""
+In-process cache for AERIS responses.
+
+Entries are keyed by endpoint, location and query parameters and expire
+after a per-endpoint time to live.  The cache holds a limited number of
+entries, the least recently used entry is dropped when it's full.
+"""
+import time
+from collections import OrderedDict
+
+# Time to live, in seconds, for each endpoint
+TTL = {
+        'observations': 60,
+        'observations/summary': 60,
+        'forecasts': 600,
+        }
+DEFAULT_TTL = 60
+
+class ResponseCache(object):
+    def __init__(self, max_size=32, ttl=None):
+        self.max_size = max_size
+        self.ttl = dict(TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, extra, location, params):
+        return (extra, location, tuple(params))
+
+    def get(self, key, force=False):
+        if force or key not in self.entries:
+            self.misses += 1
+            return None
+
+        expires, jdata = self.entries[key]
+        if time.time() >= expires:
+            del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return jdata
+
+    def put(self, key, jdata):
+        ttl = self.ttl.get(key[0], DEFAULT_TTL)
+        self.entries[key] = (time.time() + ttl, jdata)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
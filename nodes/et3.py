@@ -5,19 +5,7 @@
 # http://edis.ifas.ufl.edu/pdffiles/ae/ae45900.pdf
 
 import math
-
-# Variables
-tMin = 0
-tMax = 0
-hMin = 0
-hMax = 0
-solarRadiation = None
-elevation = 0
-plantType = 0.23
-latitude = 0
-windSpeed = 0
-julianDay = 0
-
+import time
 
 # Formulas and constants
 vaporRate = 237.3
@@ -40,6 +28,9 @@ def mph2ms (mph): # MPH to m/s
 def kph2ms (kph): # KPH to m/s
     return kph / 3.6
 
+def mm2inch (mm):
+    return mm / 25.4
+
 def deg2rad(deg):
     return math.pi / 180 * deg
 
@@ -125,7 +116,8 @@ def calc_solar_radiation(t_min, t_max, lat, declination, julian_day):
 # latitude in degrees
 # avg_ws in m/s
 # solar_radiation in W/m2
-def evapotranspriation(max_t, min_t, solar_radiation, avg_ws, elevation, max_h, min_h, latitude, canopy_coefficient, day):
+# table is an optional SolarTable for the latitude and elevation
+def evapotranspriation(max_t, min_t, solar_radiation, avg_ws, elevation, max_h, min_h, latitude, canopy_coefficient, day, table=None):
 
     julian_day = day
 
@@ -162,30 +154,18 @@ def evapotranspriation(max_t, min_t, solar_radiation, avg_ws, elevation, max_h,
     # step 11.1, vapor pressure deficit
     vp_deficit = vp_curve - vp_actual
 
-    # step 12.1, relative sun earth distance
-    dist = relative_earth_sun_distance(julian_day)
-
-    # step 12.2, solar declination
-    declination = solar_declination(julian_day)
-
-    # step 13, latitude in radians
-    latitude_r = deg2rad(latitude)
+    # steps 12 - 16, extraterrestrial and clear sky solar radiation
+    if table is None:
+        table = SolarTable(latitude, elevation)
+    (Ra, Rso) = table.terms(julian_day)
 
     ## Testing solar radiation calculation
     if solar_radiation is None:
-        Rs = calc_solar_radiation(min_t, max_t, latitude_r, declination, julian_day)
+        # same as calc_solar_radiation()
+        Rs = 0.17 * math.sqrt(max_t - min_t) * Ra
     else:
         Rs = w2mj(solar_radiation)
 
-    # step 14, sunset hour angle
-    angle = sunset_hour_angle(latitude_r, declination)
-
-    # step 15, extraerrestrial radiation
-    Ra = extraterrestrial_radiation(dist, angle, latitude_r, declination)
-
-    # step 16, clear sky solar radiation
-    Rso = clear_sky_solar_radiation(elevation, Ra)
-
     # step 17, net solar radiation
     Rns = (1 - canopy_coefficient) * Rs
 
@@ -210,92 +190,150 @@ def evapotranspriation(max_t, min_t, solar_radiation, avg_ws, elevation, max_h,
 
 
 """
-Use the global scope'd variables instead of passing in everything. 
-This is to simulate what we might do with a class that may want to
-build up the values over time.  I.E. get humidity values every 5
-minutes during the day and tack min/max.
+The solar terms (steps 12 - 16) only depend on the day of the year,
+latitude and elevation.  SolarTable keeps them for one location, each
+day's terms are calculated the first time they're needed and then
+re-used instead of being calculated for every forecast day on every
+poll.
 """
-def get_et0():
+class SolarTable(object):
+    def __init__(self, latitude, elevation):
+        self.latitude = latitude
+        self.elevation = elevation
+        self.latitude_r = deg2rad(latitude)
+        self.days = {}
 
-    # step 1, mean daily air temperature C
-    mean_daily_temp = (tMax + tMin) / 2.0
+    def matches(self, latitude, elevation):
+        return self.latitude == latitude and self.elevation == elevation
 
-    # step 2, mean solar radiation in mgajoules / m2
-    #Rs = w2mj(solarRadiation)
+    # (Ra, Rso) for the julian day
+    def terms(self, julian_day):
+        terms = self.days.get(julian_day)
+        if terms is None:
+            # step 12.1, relative sun earth distance
+            dist = relative_earth_sun_distance(julian_day)
 
-    # step 4, slope of saturation vapor pressure curve
-    vp_slope = saturation_vapor_pressure_curve_slope(mean_daily_temp)
+            # step 12.2, solar declination
+            declination = solar_declination(julian_day)
 
-    # step 5, atmospheric pressure
-    pressure = atmospheric_pressure(elevation)
+            # step 14, sunset hour angle (limited to polar day/night)
+            omega = -math.tan(self.latitude_r) * math.tan(declination)
+            angle = math.acos(min(1.0, max(-1.0, omega)))
 
-    # step 6, psychrometric constant
-    psychrometric = psychrometric_constant(pressure)
-
-    # step 7, delta term
-    delta = delta_term(vp_slope, psychrometric, windSpeed)
-
-    # step 8, psi term
-    psi = psi_term(vp_slope, psychrometric, windSpeed)
-
-    # step 9, temperature term
-    t_term = temperature_term(mean_daily_temp, windSpeed)
-
-    # step 10, mean saturation vapor pressure curve
-    vp_curve = (saturation_vapor(tMax) + saturation_vapor(tMin)) / 2
-
-    # step 11, actual vapor pressure
-    vp_actual = saturation_vapor_pressure_actual(tMin, tMax, hMin, hMax)
-
-    # step 11.1, vapor pressure deficit
-    vp_deficit = vp_curve - vp_actual
+            # step 15, extraerrestrial radiation
+            Ra = extraterrestrial_radiation(dist, angle, self.latitude_r, declination)
 
-    # step 12.1, relative sun earth distance
-    dist = relative_earth_sun_distance(julianDay)
+            # step 16, clear sky solar radiation
+            Rso = clear_sky_solar_radiation(self.elevation, Ra)
 
-    # step 12.2, solar declination
-    declination = solar_declination(julianDay)
+            terms = (Ra, Rso)
+            self.days[julian_day] = terms
+        return terms
 
-    # step 13, latitude in radians
-    latitude_r = deg2rad(latitude)
-
-    ## Testing solar radiation calculation
-    if solarRadiation is None:
-        Rs = calc_solar_radiation(tMin, tMax, latitude_r, declination, julianDay)
-    else:
-        Rs = w2mj(solarRadiation)
-
-    # step 14, sunset hour angle
-    angle = sunset_hour_angle(latitude_r, declination)
-
-    # step 15, extraerrestrial radiation
-    Ra = extraterrestrial_radiation(dist, angle, latitude_r, declination)
-
-    # step 16, clear sky solar radiation
-    Rso = clear_sky_solar_radiation(elevation, Ra)
-
-    # step 17, net solar radiation
-    Rns = (1 - plantType) * Rs
-
-    # step 18, net outgoing long wave solar radiation
-    Rnl = long_wave_radiation(tMin, tMax, vp_actual, Rs, Rso)
-
-    # step 19, net radiation
-    Rn = Rns - Rnl
-
-    # step 19.1, net radiation in mm
-    Rng = Rn * 0.408
-
-    # step FS1, radiation term ETrad
-    radiation_term = delta * Rng
 
+"""
+Calculate ETo for a number of days at once.  Each of the weather
+arguments is a list with one entry per day, latitude, elevation and
+canopy_coefficient are the same for every day.  This doesn't use any
+global state so it's safe to call from more than one thread.
 
-    # step FS2, wind term ETwind
-    wind_term = psi * t_term * (vp_curve - vp_actual)
+table is an optional SolarTable for the location.
+"""
+def evapotranspiration_batch(max_t, min_t, avg_ws, max_h, min_h, days, latitude, elevation, canopy_coefficient, solar_radiation=None, table=None):
+    if table is None:
+        table = SolarTable(latitude, elevation)
+    result = []
+    for i in range(len(days)):
+        sr = None if solar_radiation is None else solar_radiation[i]
+        result.append(evapotranspriation(max_t[i], min_t[i], sr, avg_ws[i], elevation, max_h[i], min_h[i], latitude, canopy_coefficient, days[i], table))
+    return result
 
-    # step final
-    return radiation_term + wind_term
 
+"""
+Running totals for today's observations, used to calculate the ETo so
+far today.  Only the min/max/sums are kept, not the observations, and
+everything resets when the first observation of a new day is added.
+The day is the location's local day when the observation's UTC offset
+is known, otherwise the host's.
+
+Solar radiation (W/m2) is integrated over the time between observations
+that have it, to get the average radiation over that time.
+"""
+class ObservedDay(object):
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, day):
+        self.day = day
+        self.start = None
+        self.t_min = None
+        self.t_max = None
+        self.h_min = None
+        self.h_max = None
+        self.wind_sum = 0.0
+        self.wind_count = 0
+        self.solar_energy = 0.0  # J/m2
+        self.solar_time = 0.0    # seconds the energy was integrated over
+        self.solar_seen = None   # latest solar reading
+        self.last_time = None
+        self.last_solar = None
+
+    # temperature in C, humidity in %, wind in m/s, solar in W/m2 or None,
+    # offset is the location's UTC offset in seconds, if known.
+    def add(self, timestamp, temp, humidity, wind, solar, offset=None):
+        if offset is None:
+            lt = time.localtime(timestamp)
+            midnight = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1))
+        else:
+            lt = time.gmtime(timestamp + offset)
+            midnight = timestamp - (lt.tm_hour * 3600 + lt.tm_min * 60 + lt.tm_sec)
+        day = (lt.tm_year, lt.tm_yday)
+        if day != self.day:
+            self.reset(day)
+            self.start = midnight
+
+        if self.last_time is not None and timestamp <= self.last_time:
+            return  # already have this observation
+
+        self.t_min = temp if self.t_min is None else min(self.t_min, temp)
+        self.t_max = temp if self.t_max is None else max(self.t_max, temp)
+        self.h_min = humidity if self.h_min is None else min(self.h_min, humidity)
+        self.h_max = humidity if self.h_max is None else max(self.h_max, humidity)
+        self.wind_sum += wind
+        self.wind_count += 1
+
+        if solar is not None:
+            if self.last_solar is not None:
+                self.solar_energy += (solar + self.last_solar) / 2 * (timestamp - self.last_time)
+                self.solar_time += timestamp - self.last_time
+            self.solar_seen = solar
+        self.last_solar = solar
+        self.last_time = timestamp
+
+    """
+    Estimate the ETo so far today.  This is the daily ETo calculated
+    from today's observed values, scaled by the part of the day that
+    has passed.  The solar radiation used is the average over the time
+    we have readings for (after a restart that's not since midnight),
+    or the only reading if there's just one.
+    """
+    def eto(self, latitude, elevation, canopy_coefficient):
+        if self.last_time is None:
+            return None
+
+        elapsed = self.last_time - self.start
+        if elapsed <= 0:
+            return 0.0
+
+        solar = None
+        if self.solar_time > 0:
+            solar = self.solar_energy / self.solar_time
+        elif self.solar_seen is not None:
+            solar = self.solar_seen
+
+        wind = self.wind_sum / self.wind_count
+        daily = evapotranspriation(self.t_max, self.t_min, solar, wind, elevation, self.h_max, self.h_min, latitude, canopy_coefficient, self.day[1])
+        return max(0.0, daily * min(1.0, elapsed / 86400.0))
 
 
 if __name__ == '__main__':
@@ -307,6 +345,37 @@ if __name__ == '__main__':
     et0 = evapotranspriation(27.3, 10.7, None, 1.3, 401.33, 91, 36, 36.82, 0.23, 289)
     print("et0 = ", et0)
 
+    # The batch calculation should match the single day calculation
+    max_t = [27.3, 30.1, 18.2, 12.0, 35.5, 22.2, 8.4]
+    min_t = [10.7, 15.3, 9.9, 1.5, 20.0, 21.0, -3.2]
+    ws = [1.3, 0.5, 4.2, 6.0, 2.2, 0.0, 3.3]
+    max_h = [91, 80, 100, 95, 60, 99, 85]
+    min_h = [36, 30, 70, 50, 15, 90, 40]
+    days = [289, 1, 90, 180, 200, 365, 366]
+    batch = evapotranspiration_batch(max_t, min_t, ws, max_h, min_h, days, 36.82, 401.33, 0.23)
+    for i in range(len(days)):
+        single = evapotranspriation(max_t[i], min_t[i], None, ws[i], 401.33, max_h[i], min_h[i], 36.82, 0.23, days[i])
+        print("day {:3d}  single = {:.6f}  batch = {:.6f}".format(days[i], single, batch[i]))
+        assert abs(single - batch[i]) < 1e-9
+
+    table = SolarTable(36.82, 401.33)
+    batch = evapotranspiration_batch(max_t, min_t, ws, max_h, min_h, days, 36.82, 401.33, 0.23, table=table)
+    for i in range(len(days)):
+        single = evapotranspriation(max_t[i], min_t[i], None, ws[i], 401.33, max_h[i], min_h[i], 36.82, 0.23, days[i])
+        assert abs(single - batch[i]) < 1e-9
+
+    # Micro-benchmark of a 7 day forecast
+    import timeit
+    n = 2000
+    def scalar():
+        for i in range(len(days)):
+            evapotranspriation(max_t[i], min_t[i], None, ws[i], 401.33, max_h[i], min_h[i], 36.82, 0.23, days[i])
+    t_scalar = timeit.timeit(scalar, number=n)
+    t_batch = timeit.timeit(lambda: evapotranspiration_batch(max_t, min_t, ws, max_h, min_h, days, 36.82, 401.33, 0.23), number=n)
+    t_table = timeit.timeit(lambda: evapotranspiration_batch(max_t, min_t, ws, max_h, min_h, days, 36.82, 401.33, 0.23, table=table), number=n)
+    print("per 7 day forecast: scalar {:.1f}us  batch {:.1f}us  batch+table {:.1f}us".format(
+        t_scalar / n * 1e6, t_batch / n * 1e6, t_table / n * 1e6))
+
 
 
 
@@ -0,0 +1,106 @@
+"""
+Rolling history of recent observations.
+
+Observations are kept in fixed size ring buffers (array module, so the
+memory used never grows) along with the rolling statistics we publish:
+
+    pressure change over the last 3 hours
+    temperature high/low over the last 24 hours
+    maximum wind gust over the last 24 hours
+
+The min/max values use monotonic queues and the pressure trend keeps a
+pointer to the observation closest to 3 hours ago, so each update is
+O(1) (amortized) no matter how much history is kept.
+
+To cover the whole 24 hour window with a fixed number of slots,
+observations that arrive less than window/capacity seconds after the
+previous one are skipped.
+"""
+from array import array
+from collections import deque
+
+class History(object):
+    def __init__(self, capacity=512, window=86400, trend_window=10800):
+        self.capacity = capacity
+        self.window = window
+        self.trend_window = trend_window
+        self.min_interval = window / capacity
+
+        self.times = array('d', [0.0]) * capacity
+        self.temp = array('d', [0.0]) * capacity
+        self.pressure = array('d', [0.0]) * capacity
+        self.gust = array('d', [0.0]) * capacity
+
+        # sequence number of the next observation, the slot used is
+        # seq % capacity.
+        self.seq = 0
+        self.oldest = 0
+        self.trend_seq = 0
+        self.temp_max = deque()
+        self.temp_min = deque()
+        self.gust_max = deque()
+
+    def __len__(self):
+        return self.seq - self.oldest
+
+    def add(self, timestamp, temp, pressure, gust):
+        if len(self) > 0 and timestamp - self.times[(self.seq - 1) % self.capacity] < self.min_interval:
+            return False
+
+        # drop the oldest observation if the buffer is full
+        if len(self) == self.capacity:
+            self._expire(self.oldest + 1)
+
+        i = self.seq % self.capacity
+        self.times[i] = timestamp
+        self.temp[i] = temp
+        self.pressure[i] = pressure
+        self.gust[i] = gust
+
+        self._push(self.temp_max, self.temp, temp, lambda a, b: a <= b)
+        self._push(self.temp_min, self.temp, temp, lambda a, b: a >= b)
+        self._push(self.gust_max, self.gust, gust, lambda a, b: a <= b)
+        self.seq += 1
+
+        # drop observations that are outside the window
+        oldest = self.oldest
+        while oldest < self.seq - 1 and self.times[oldest % self.capacity] < timestamp - self.window:
+            oldest += 1
+        self._expire(oldest)
+
+        # move the trend pointer up to the observation closest to (but
+        # not after) trend_window seconds ago
+        self.trend_seq = max(self.trend_seq, self.oldest)
+        while self.trend_seq + 1 < self.seq and self.times[(self.trend_seq + 1) % self.capacity] <= timestamp - self.trend_window:
+            self.trend_seq += 1
+
+        return True
+
+    # Remove queue entries that are no longer better than the new value
+    def _push(self, queue, values, value, replaces):
+        while len(queue) > 0 and replaces(values[queue[-1] % self.capacity], value):
+            queue.pop()
+        queue.append(self.seq)
+
+    def _expire(self, oldest):
+        self.oldest = oldest
+        for queue in (self.temp_max, self.temp_min, self.gust_max):
+            while len(queue) > 0 and queue[0] < oldest:
+                queue.popleft()
+
+    def temp_high(self):
+        return self.temp[self.temp_max[0] % self.capacity] if len(self) > 0 else None
+
+    def temp_low(self):
+        return self.temp[self.temp_min[0] % self.capacity] if len(self) > 0 else None
+
+    def gust_high(self):
+        return self.gust[self.gust_max[0] % self.capacity] if len(self) > 0 else None
+
+    # Pressure change since ~trend_window seconds ago (or since the
+    # oldest observation if we don't have that much history yet).
+    def pressure_change(self):
+        if len(self) < 2:
+            return 0.0
+        latest = self.pressure[(self.seq - 1) % self.capacity]
+        return latest - self.pressure[self.trend_seq % self.capacity]
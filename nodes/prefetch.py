@@ -0,0 +1,133 @@
+"""
+Fetch weather data in the background.
+
+The AERIS requests, parsing and ETo calculations run on a worker thread
+on their own schedule.  Parsed driver values go into a double buffered
+Results object: the worker fills the back buffer and swaps it in as the
+front buffer when a fetch is complete.  The Polyglot poll and query
+handlers only publish the front buffer, so they don't wait on the
+network.
+"""
+import time
+import threading
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.back = {}
+        self.front = {}
+        self.seq = 0
+
+    # Same arguments as Publisher.set(), force is used when publishing.
+    def set(self, node, driver, value, uom, force=False):
+        if node is not None:
+            self.back.setdefault(node.address, {})[driver] = (value, uom)
+
+    # Merge the new values into a new front buffer.  The old front buffer
+    # isn't changed so a reader can keep using it without the lock.
+    def commit(self):
+        with self.lock:
+            if len(self.back) == 0:
+                return self.seq
+            front = dict(self.front)
+            for address in self.back:
+                drivers = dict(front.get(address, {}))
+                drivers.update(self.back[address])
+                front[address] = drivers
+            self.front = front
+            self.back = {}
+            self.seq += 1
+            return self.seq
+
+    # (sequence number, {address: {driver: (value, uom)}}) of the latest
+    # complete results.
+    def latest(self):
+        with self.lock:
+            return (self.seq, self.front)
+
+    def forget(self, address):
+        with self.lock:
+            if address in self.front:
+                self.front = dict(self.front)
+                del self.front[address]
+
+
+class Prefetcher(object):
+    def __init__(self):
+        self.tasks = {}
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.woken = False
+        self.refresh = False
+        self.running = False
+        self.thread = None
+        self.on_refresh = None
+
+    # Call fn(force, refresh) every interval seconds, force and refresh
+    # are set when the run was asked for by wake().
+    def add(self, name, fn, interval):
+        self.tasks[name] = {'fn': fn, 'interval': interval, 'next': 0}
+
+    def set_interval(self, name, interval):
+        if name in self.tasks:
+            self.tasks[name]['interval'] = interval
+
+    # The first run of each task is an interval from now, the caller
+    # should have just fetched the data.
+    def start(self):
+        if self.running:
+            return
+        for task in self.tasks.values():
+            task['next'] = time.time() + task['interval']
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='aeris-prefetch', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    # Run every task now (forced), refresh also skips the cache.
+    # on_refresh is called when it's done.
+    def wake(self, refresh=False):
+        with self.lock:
+            self.woken = True
+            if refresh:
+                self.refresh = True
+            for task in self.tasks.values():
+                task['next'] = 0
+            self.wakeup.set()
+
+    def _run(self):
+        while self.running:
+            # a wake() after this is seen on the next loop
+            with self.lock:
+                self.wakeup.clear()
+                force = self.woken
+                refresh = self.refresh
+                self.woken = False
+                self.refresh = False
+
+            for name in self.tasks:
+                task = self.tasks[name]
+                with self.lock:
+                    if time.time() < task['next']:
+                        continue
+                    task['next'] = time.time() + task['interval']
+                try:
+                    task['fn'](force, refresh)
+                except Exception as e:
+                    LOGGER.error('Background {} update failed: {}'.format(name, e))
+
+            if force and self.on_refresh is not None:
+                try:
+                    self.on_refresh()
+                except Exception as e:
+                    LOGGER.error('Background refresh update failed: {}'.format(e))
+
+            wait = min([t['next'] for t in self.tasks.values()] or [time.time() + 60]) - time.time()
+            if wait > 0:
+                self.wakeup.wait(wait)
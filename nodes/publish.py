@@ -0,0 +1,112 @@
+"""
+Publish driver values to the ISY.
+
+Keeps the last value published for each node/driver and drops updates
+that are within the driver's deadband of that value.  This avoids
+sending events to the ISY for weather values that haven't really
+changed.
+
+Between begin() and flush() the driver changes for a node are collected
+and then sent to Polyglot as a single message instead of one message
+per driver.
+"""
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+# Smallest change that gets published.  Drivers not listed only publish
+# when the value changes.
+DEADBANDS = {
+        'CLITEMP': 0.1,  # temperature
+        'DEWPT': 0.1,    # dew point
+        'GV2': 0.1,      # feels like
+        'HEATIX': 0.1,   # heat index
+        'WINDCH': 0.1,   # wind chill
+        'GV0': 0.1,      # high temp
+        'GV1': 0.1,      # low temp
+        'CLIHUM': 1,     # humidity
+        'GV14': 1,       # cloud cover
+        'WINDDIR': 1,    # wind direction
+        }
+
+class Publisher(object):
+    def __init__(self, deadbands=None):
+        self.deadbands = dict(DEADBANDS)
+        if deadbands is not None:
+            self.deadbands.update(deadbands)
+        self.last = {}
+        self.pending = {}
+        self.coalesce = True
+        self.emitted = 0
+        self.suppressed = 0
+        self.messages = 0
+
+    def _within_deadband(self, driver, last, value):
+        if last is None:
+            return False
+        try:
+            delta = abs(float(value) - float(last))
+        except (TypeError, ValueError):
+            return value == last
+        return delta <= self.deadbands.get(driver, 0) + 1e-9
+
+    def set(self, node, driver, value, uom, force):
+        key = (node.address, driver)
+        last, last_uom = self.last.get(key, (None, None))
+
+        if not force and uom == last_uom and self._within_deadband(driver, last, value):
+            self.suppressed += 1
+            return False
+
+        if node.address in self.pending:
+            # Update the value now, report it when the node is flushed
+            changed = node.setDriver(driver, value, False, force, uom)
+            if changed or force:
+                self.pending[node.address].append(driver)
+        else:
+            changed = node.setDriver(driver, value, True, force, uom)
+            if changed or force:
+                self.messages += 1
+
+        self.last[key] = (value, uom)
+        self.emitted += 1
+        return True
+
+    def begin(self, node):
+        if self.coalesce and node is not None:
+            self.pending[node.address] = []
+
+    def flush(self, node):
+        if node is None or node.address not in self.pending:
+            return
+
+        drivers = self.pending.pop(node.address)
+        if len(drivers) == 0:
+            return
+
+        if not hasattr(node.poly, 'send'):
+            # interface can't take a batched report, send them one at a time
+            for driver in drivers:
+                node.reportDriver(driver, True)
+                self.messages += 1
+            return
+
+        message = {'set': []}
+        for d in node.drivers:
+            if d['driver'] in drivers:
+                message['set'].append({
+                    'address': node.address,
+                    'driver': d['driver'],
+                    'value': str(d['value']),
+                    'uom': d['uom'],
+                    'text': d.get('text')
+                    })
+        node.poly.send(message, 'status')
+        self.messages += 1
+
+    def forget(self, address):
+        for key in [k for k in self.last if k[0] == address]:
+            del self.last[key]
+
+    def stats(self):
+        return {'emitted': self.emitted, 'suppressed': self.suppressed, 'messages': self.messages}
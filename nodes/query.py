@@ -2,15 +2,37 @@
 Do I want this encapsulated in a class or not?
 
 export:
-    query_conditions(update_function, force)
-    query_forecasts(force)
+    query_all(address, units, force, refresh)
+    query_conditions(address, units, force, refresh)
+    query_forecasts(units, force, refresh)
 
+The collect_ functions fetch and parse the data into results without
+publishing it (used by the background prefetch worker), publish()
+sends the latest results to the ISY.  The query_ functions do both.
 """
 import udi_interface
 import requests
 import time
 import datetime
+import os
+import urllib.parse
+import concurrent.futures
+import random
+import threading
+import hashlib
+import json
+from requests.adapters import HTTPAdapter
 from nodes import weather_codes as wx
+from nodes import et3
+from nodes import cache
+from nodes import publish
+from nodes import breaker
+from nodes import history
+from nodes import schedule
+from nodes import quota
+from nodes import flight
+from nodes import schema
+from nodes import prefetch
 
 LOGGER = udi_interface.LOGGER
 
@@ -26,7 +48,7 @@ class WeatherData:
 
     def __init__(self, units):
         self.__dict__['isMetric'] = True
-        self.__dict__['ST']      = {'uom': 2,   'tag': '',                'ftag': '', 'parse': None}   # node server status
+        self.__dict__['ST']      = {'uom': 25,  'tag': '',                'ftag': '', 'parse': None}   # node server status
         self.__dict__['CLITEMP'] = {'uom': 4,   'tag': 'tempC',           'ftag': 'tempC', 'parse': None}   # temperature
         self.__dict__['CLIHUM']  = {'uom': 22,  'tag': 'humidity',        'ftag': 'humidity', 'parse': None}   # humidity
         self.__dict__['BARPRES'] = {'uom': 117, 'tag': 'pressureMB',      'ftag': 'pressureMB', 'parse': None} # pressure
@@ -89,9 +111,11 @@ class WeatherData:
             self.__dict__['GV8']     = {'uom': 48,  'tag': 'windSpeedMinMPH', 'ftag': 'windSpeedMinMPH', 'parse': None} # min wind   
             self.__dict__['GV15']    = {'uom': 105, 'tag': 'snowDepthIN',     'ftag': 'snowIN',          'parse': None} # snow depth
 
-        self.__dict__['GV11']['parse'] = 'self._parse_coverage_codes'
-        self.__dict__['GV12']['parse'] = 'self._parse_intensity_codes'
-        self.__dict__['GV13']['parse'] = 'self._parse_weather_codes'
+        self.__dict__['GV11']['parse'] = self._parse_coverage_codes
+        self.__dict__['GV12']['parse'] = self._parse_intensity_codes
+        self.__dict__['GV13']['parse'] = self._parse_weather_codes
+
+        self.__dict__['_tables'] = {}
 
     def __setattr__(self, name, value):
         if name in self.__dict__:
@@ -199,25 +223,129 @@ class WeatherData:
             return code_map[code]
         return 16
 
+    # Returns None if the tag isn't in the data
     def parse(self, name, data):
         tag = self.__dict__[name]['tag']
         if tag in data:
             if self.__dict__[name]['parse'] is not None:
-                return eval(self.__dict__[name]['parse'])(data[tag])
+                return self.__dict__[name]['parse'](data[tag])
             else:
                 return data[tag]
-        raise self.ConstError("{}: {} not found in data.".format(name, tag))
+        return None
 
     def fparse(self, name, data):
         tag = self.__dict__[name]['ftag']
         if tag in data:
             if self.__dict__[name]['parse'] is not None:
-                return eval(self.__dict__[name]['parse'])(data[tag])
+                return self.__dict__[name]['parse'](data[tag])
             else:
                 return data[tag]
-        raise self.ConstError("{}: {} not found in data.".format(name, tag))
+        return None
+
+    # Build the function that converts a raw value for a driver into
+    # the value we send to the ISY.
+    def _converter(self, name, prec):
+        parse = self.__dict__[name]['parse']
+        scale = 1
+        if name == 'GV15' and self.isMetric:
+            scale = 10 # snow depth is in cm, convert to mm
+
+        def convert(v):
+            if parse is not None:
+                v = parse(v)
+            if v == None or v == "None":
+                v = 0
+            return round(float(v) * scale, prec)
+
+        return convert
+
+    """
+    Return the list of (driver, tag, uom, converter) tuples for a node's
+    drivers.  Drivers that don't come directly from the data (no tag)
+    are not included.  The list is built once per set of drivers and
+    then re-used.
+    """
+    def table(self, drivers, forecast=False, prec=1):
+        key = (tuple(d['driver'] for d in drivers), forecast, prec)
+        if key in self._tables:
+            return self._tables[key]
+
+        tag_key = 'ftag' if forecast else 'tag'
+        table = []
+        for d in drivers:
+            name = d['driver']
+            if name not in self.__dict__:
+                continue
+            if not forecast and name == 'PRECIP':
+                continue # this comes from a different query
+            tag = self.__dict__[name][tag_key]
+            if tag == '':
+                continue
+            table.append((name, tag, self.__dict__[name]['uom'], self._converter(name, prec)))
+
+        self._tables[key] = tuple(table)
+        return self._tables[key]
+
+
+# Default for looking up a tag that may not be in the data
+MISSING = object()
+
+# One WeatherData per unit system, created on first use.
+_weather_maps = {}
 
+def weather_map(units):
+    if units not in _weather_maps:
+        _weather_maps[units] = WeatherData(units)
+    return _weather_maps[units]
+
+
+
+
+"""
+Errors from a request to the AERIS API.  kind is one of:
+    timeout    - connect or read timed out
+    connection - couldn't connect to the server
+    http       - server returned an HTTP error status
+    json       - response body wasn't valid JSON
+    aeris      - AERIS returned an error object
+    quota      - request not sent, the access quota is used up
+"""
+class FetchError(Exception):
+    def __init__(self, kind, message, status=None, retry=False):
+        super(FetchError, self).__init__(message)
+        self.kind = kind
+        self.status = status
+        self.retry = retry
+
+    def __str__(self):
+        return '{}: {}'.format(self.kind, super(FetchError, self).__str__())
+
+
+"""
+The per location state: the nodes a location's data goes to and the
+history used for its observed ETo, pressure trend and 24 hour drivers.
+The first location updates the controller and forecast_<day> nodes, the
+others a cond_<n> node and forecast_<n>_<day> nodes.
+"""
+class Site(object):
+    def __init__(self, index, location, elevation):
+        self.index = index
+        self.location = location
+        self.elevation = elevation
+        self.latitude = 0
+        self.solar_table = None
+        self.observed = et3.ObservedDay()
+        self.history = history.History()
+        self.scheduler = schedule.Scheduler()
+        if index == 0:
+            self.address = 'controller'
+        else:
+            self.address = 'cond_' + str(index)
 
+    def forecast_address(self, day):
+        if self.index == 0:
+            return 'forecast_' + str(day)
+        return 'forecast_{}_{}'.format(self.index, day)
 
 
 class queries(object):
@@ -233,48 +361,483 @@ class queries(object):
         self.__dict__['plant_type'] = 0
         self.__dict__['elevation'] = 0
         self.__dict__['configured'] = False
-        self.api = 'http://api.aerisapi.com/'
-        self.latitude = 0
+        self.api = os.environ.get('AERIS_API', 'https://api.aerisapi.com/')
+        self.batch = True
+        self.batch_size = 31
+        self.pool_size = 4
+        self.request_deadline = 30
+        self.timeout = (5, 15)    # connect, read timeouts in seconds
+        self.retries = 2
+        self.backoff = 1
+        self.poll_interval = 200
+        self.errors = {}
+        self.session = None
+        self.executor = None
+        self.request_count = 0
+        self.cache = cache.ResponseCache()
+        self.publisher = publish.Publisher()
+        self.results = prefetch.Results()
+        self.published = 0
+        self.publish_lock = threading.Lock()
+        self.breaker = breaker.CircuitBreaker()
+        self.quota_denied = set()
+        self.last_good = {}
+        self.updated = 0
+        self.node_drivers = {}
+        self.fields = {}
+        self.sites = []
+        self.quota = quota.Quota()
+        self.flight = flight.SingleFlight()
+        self.fingerprints = {}
+        self.schema = schema.Schema()
+        self.fingerprint_hits = 0
+        self.fingerprint_misses = 0
         self.tag = {}
 
-
-
     def __setattr__(self, key, value):
         self.__dict__[key] = value
 
-    # Make and call the actual query URL
-    def _get_weather_data(self, extra, lat=None, long=None):
-        request = self.api + extra + '/'
+    # Set the locations and their elevations (one for all of them or one
+    # each).  A site whose location and elevation didn't change is kept,
+    # with its history.
+    def set_locations(self, locations, elevations):
+        sites = []
+        for i in range(len(locations)):
+            elevation = elevations[min(i, len(elevations) - 1)]
+            if i < len(self.sites) and self.sites[i].location == locations[i] and self.sites[i].elevation == elevation:
+                sites.append(self.sites[i])
+            else:
+                sites.append(Site(i, locations[i], elevation))
+        self.sites = sites
+        self.location = locations[0]
+        self.elevation = elevations[0]
+
+    # The sites to update, the first one's conditions go to address
+    def _sites(self, address=None):
+        if address is not None and len(self.sites) > 0:
+            self.sites[0].address = address
+        return self.sites
+
+    # Register the drivers of the node type that's updated from an
+    # endpoint so we only ask for the fields those drivers use.
+    def register_drivers(self, extra, drivers):
+        self.node_drivers[extra] = drivers
+        self.fields = {}
 
-        request += self.location
-        request += '?client_id=' + self.client_id
-        request += '&client_secret=' + self.client_secret
+    """
+    Build the list of response fields needed for an endpoint from the
+    tags the node's drivers use in the current units, plus the other
+    values we use from the response.
+    """
+    def _fields(self, extra):
+        key = (extra, self.units)
+        if key in self.fields:
+            return self.fields[key]
 
+        if extra not in self.node_drivers:
+            return None
+
+        wmap = weather_map(self.units)
+        if extra == 'observations':
+            fields = ['loc.lat', 'ob.timestamp', 'ob.dateTimeISO']
+            prefix = 'ob.'
+            table = wmap.table(self.node_drivers[extra], False)
+        else:
+            fields = ['periods.timestamp', 'periods.dateTimeISO', 'periods.maxHumidity', 'periods.minHumidity']
+            prefix = 'periods.'
+            table = wmap.table(self.node_drivers[extra], True)
+
+        for (driver, tag, uom, convert) in table:
+            if prefix + tag not in fields:
+                fields.append(prefix + tag)
+
+        self.fields[key] = ','.join(fields)
+        return self.fields[key]
+
+    # Query parameters specific to an endpoint, not including location
+    # or credentials.
+    def _request_params(self, extra):
+        params = []
         if extra == 'forecasts':
-            request += '&filter=mdnt2mdnt'
-            request += '&precise'
-            request += '&limit=' + str(self.days)
+            params.append('filter=mdnt2mdnt')
+            params.append('precise')
+            params.append('limit=' + str(self.days))
 
         if extra == 'observations/summary':
-            request += '&fields=periods.summary.precip'
+            params.append('fields=periods.summary.precip')
+        elif extra in self.node_drivers:
+            params.append('fields=' + self._fields(extra))
 
         #FIXME: add unit support if available
-        #request += '&units=' + self.units
+        #params.append('units=' + self.units)
 
-        LOGGER.debug('request = %s' % request)
+        return params
+
+    def _credentials(self):
+        return '?client_id=' + self.client_id + '&client_secret=' + self.client_secret
+
+    """
+    All requests go through a single persistent session so that the
+    TCP connection (and TLS session) is kept alive and reused from one
+    poll to the next instead of being set up for every request.
+    """
+    def _get_session(self):
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self.session.headers.update({'Connection': 'keep-alive'})
+        return self.session
+
+    # Batch the requests for several endpoints into one request, or make
+    # them at the same time on pool_size threads.  The session and thread
+    # pool are rebuilt for a new pool size.
+    def configure_requests(self, batch, pool_size):
+        self.batch = batch
+        if pool_size != self.pool_size:
+            self.pool_size = pool_size
+            self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    # Number of connections opened vs. requests made on the session.
+    def connection_stats(self):
+        stats = {'requests': self.request_count, 'connections': 0}
+        if self.session is None:
+            return stats
+
+        # the same adapter is mounted for both http and https
+        for adapter in set(self.session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                stats['connections'] += pool.num_connections
+        return stats
+
+    # Make a single request, raise FetchError if it fails.  The requests
+    # exception text has the full URL, credentials included, so only the
+    # exception type and endpoint go in the error.
+    def _request(self, request, timeout):
+        start = time.time()
+        endpoint = urllib.parse.urlsplit(request).path
+        try:
+            c = self._get_session().get(request, timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            raise FetchError('timeout', '{} requesting {}'.format(type(e).__name__, endpoint), retry=True)
+        except requests.exceptions.RequestException as e:
+            raise FetchError('connection', '{} requesting {}'.format(type(e).__name__, endpoint), retry=True)
 
         try:
-            c = requests.get(request)
-            jdata = c.json()
+            self.request_count += 1
+            if c.status_code >= 400:
+                retry = c.status_code >= 500 or c.status_code == 429
+                raise FetchError('http', 'HTTP status {}'.format(c.status_code), c.status_code, retry)
+
+            try:
+                jdata = c.json()
+            except ValueError as e:
+                raise FetchError('json', str(e), c.status_code)
+        finally:
             c.close()
-            LOGGER.debug(jdata)
-        except:
-            LOGGER.error('HTTP request failed for api.aerisapi.com')
+
+        stats = self.connection_stats()
+        LOGGER.debug('request took {:.3f}s, {} connection(s) opened for {} requests, {} coalesced'.format(time.time() - start, stats['connections'], stats['requests'], self.flight.coalesced))
+        LOGGER.debug(jdata)
+
+        if not isinstance(jdata, dict):
+            raise FetchError('json', 'unexpected response {}'.format(type(jdata)))
+
+        if jdata.get('success', True) is False:
+            error = jdata.get('error') or {}
+            raise FetchError('aeris', '{}: {}'.format(error.get('code'), error.get('description')))
+
+        return jdata
+
+    """
+    Make the request, retrying timeouts, connection failures and server
+    errors with exponential backoff plus jitter.  A retry is only made
+    if it can finish before the deadline (normally the next poll).
+
+    If the same request is already being made by another thread (poll,
+    QUERY command and parameter changes run on different threads) we
+    wait for it and share its result.
+    """
+    def _get(self, request, deadline=None):
+        LOGGER.debug('request = %s' % request)
+
+        if deadline is None:
+            deadline = time.time() + self.poll_interval
+
+        return self.flight.do(request, self._get_retry, request, deadline)
+
+    def _get_retry(self, request, deadline):
+        attempt = 0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise FetchError('timeout', 'deadline passed before the request was made', retry=True)
+            timeout = (min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+            try:
+                return self._request(request, timeout)
+            except FetchError as e:
+                if not e.retry or attempt >= self.retries:
+                    raise
+
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if time.time() + delay + sum(self.timeout) > deadline:
+                    raise
+
+                LOGGER.warning('Request failed ({}), retrying in {:.1f} seconds'.format(e, delay))
+                time.sleep(delay)
+                attempt += 1
+
+    # Make and call the actual query URL
+    def _get_weather_data(self, extra, location, deadline=None):
+        request = self.api + extra + '/'
+
+        request += location
+        request += self._credentials()
+        for p in self._request_params(extra):
+            request += '&' + p
+
+        try:
+            jdata = self._get(request, deadline)
+            self.errors.pop((extra, location), None)
+        except FetchError as e:
+            LOGGER.error('HTTP request failed for api.aerisapi.com: {}'.format(e))
+            self.errors[(extra, location)] = e
             jdata = None
 
         return jdata
 
-    def query_conditions(self, address, units, force):
+    """
+    Use the batch endpoint to make a single request for multiple
+    endpoints and locations.  The batch response holds a list of
+    responses, one per request and in the same order, each formatted
+    exactly like the response from the individual endpoint.
+    """
+    def _get_batch_data(self, keys):
+        requests_list = []
+        for (extra, location) in keys:
+            r = '/' + extra + '/' + location
+            params = self._request_params(extra)
+            if len(params) > 0:
+                r += '?' + '&'.join(params)
+            # the request list is comma separated so commas inside a
+            # request have to be encoded twice
+            requests_list.append(urllib.parse.quote(r.replace(',', '%2C'), safe='/'))
+
+        request = self.api + 'batch'
+        request += self._credentials()
+        request += '&requests=' + ','.join(requests_list)
+
+        results = dict.fromkeys(keys)
+
+        try:
+            jdata = self._get(request)
+            if 'response' not in jdata:
+                raise FetchError('aeris', 'No response object in batch response.')
+        except FetchError as e:
+            LOGGER.error('Batch query failed: {}'.format(e))
+            for key in keys:
+                self.errors[key] = e
+            return results
+
+        responses = jdata['response'].get('responses', [])
+        if len(responses) != len(keys):
+            LOGGER.error('Batch query returned {} responses for {} requests'.format(len(responses), len(keys)))
+
+        for key, sub in zip(keys, responses):
+            if sub.get('success', True) is False:
+                error = sub.get('error') or {}
+                e = FetchError('aeris', '{}: {}'.format(error.get('code'), error.get('description')))
+                LOGGER.error('{} query for {} failed: {}'.format(key[0], key[1], e))
+                self.errors[key] = e
+            else:
+                self.errors.pop(key, None)
+                results[key] = sub
+
+        return results
+
+    """
+    Request each endpoint at the same time on a pool of worker threads.
+    Total time is that of the slowest request.  Requests that haven't
+    finished by the deadline are reported as returning no data.
+    """
+    def _get_concurrent(self, keys):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='aeris')
+
+        # the requests give up at the deadline too, so they don't hold
+        # the pool's threads after we've stopped waiting for them
+        deadline = time.time() + self.request_deadline
+        futures = {}
+        for key in keys:
+            futures[key] = self.executor.submit(self._get_weather_data, key[0], key[1], deadline)
+
+        results = {}
+        for key in keys:
+            try:
+                results[key] = futures[key].result(timeout=max(0, deadline - time.time()))
+            except concurrent.futures.TimeoutError:
+                futures[key].cancel()
+                e = FetchError('timeout', 'did not complete within {} seconds'.format(self.request_deadline), retry=True)
+                LOGGER.error('{} request for {} failed: {}'.format(key[0], key[1], e))
+                self.errors[key] = e
+                results[key] = None
+
+        return results
+
+    # Fetch one or more (endpoint, location) keys, batched into a single
+    # request when batch mode is enabled.  Responses still in the cache
+    # are used unless refresh is set.  forced requests (QUERY, startup)
+    # have their own quota limit.
+    def _fetch(self, keys, refresh=False, forced=False):
+        results = {}
+        missing = []
+        for (extra, location) in keys:
+            key = self.cache.key(extra, location, self._request_params(extra))
+            results[(extra, location)] = self.cache.get(key, refresh)
+            if results[(extra, location)] is None:
+                missing.append((extra, location))
+            else:
+                LOGGER.debug('Using cached {} response for {}'.format(extra, location))
+
+        if len(missing) == 0:
+            return results
+
+        if not self.breaker.allow():
+            LOGGER.warning('AERIS requests paused after repeated failures, using last good data.')
+            for key in missing:
+                results[key] = self.last_good.get(key)
+            return results
+
+        # Each request in a batch counts against the quota.  Take it in
+        # parts no bigger than the limits so a large batch can still be
+        # made, the requests denied last time go first.
+        priority = quota.HIGH if any(k[0].startswith('observations') for k in missing) else quota.LOW
+        missing.sort(key=lambda k: k not in self.quota_denied)
+        size = self.quota.max_cost(priority) or len(missing)
+        granted = []
+        for i in range(0, len(missing), size):
+            part = missing[i:i + size]
+            if self.quota.acquire(len(part), priority, forced and i == 0):
+                granted.extend(part)
+                self.quota_denied.difference_update(part)
+            else:
+                e = FetchError('quota', 'AERIS request quota used up, using last good data.')
+                LOGGER.warning('{} {}'.format(e, self.quota.stats()))
+                for key in part:
+                    self.errors[key] = e
+                    results[key] = self.last_good.get(key)
+                self.quota_denied.update(part)
+
+        if len(granted) == 0:
+            self.breaker.cancel()
+            return results
+        missing = granted
+
+        for (extra, location) in missing:
+            for site in self._sites_at(location):
+                if extra in schedule.MAX_AGE:
+                    site.scheduler.requested(extra)
+
+        if len(missing) > 1:
+            if self.batch:
+                # a batch request can only hold batch_size requests
+                for i in range(0, len(missing), self.batch_size):
+                    results.update(self._get_batch_data(missing[i:i + self.batch_size]))
+            else:
+                results.update(self._get_concurrent(missing))
+        else:
+            results[missing[0]] = self._get_weather_data(*missing[0])
+
+        # Only transport failures (timeouts, connection errors, 5xx/429)
+        # count toward the breaker, an AERIS error for one location or
+        # endpoint doesn't mean the others are failing.
+        failed = False
+        for (extra, location) in missing:
+            jdata = results[(extra, location)]
+            if jdata is None:
+                e = self.errors.get((extra, location))
+                if e is None or e.retry:
+                    failed = True
+                continue
+            key = self.cache.key(extra, location, self._request_params(extra))
+            self.cache.put(key, jdata)
+            self.last_good[(extra, location)] = jdata
+            self.updated = time.time()
+            self._update_schedule(extra, location, jdata)
+
+        if failed:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+        return results
+
+    # True when requests are failing and we're serving old data
+    def degraded(self):
+        return self.breaker.is_open()
+
+    def query_all(self, address, units, force, refresh=False):
+        self.collect_all(address, units, force, refresh)
+        self.publish(force)
+
+    def query_conditions(self, address, units, force, refresh=False):
+        self.collect_conditions(address, units, force, refresh)
+        self.publish(force)
+
+    def query_forecasts(self, units, force, refresh=False):
+        self.collect_forecasts(units, force, refresh)
+        self.publish(force)
+
+    # Publish the latest results, if there are new ones or force is set.
+    def publish(self, force=False):
+        with self.publish_lock:
+            (seq, state) = self.results.latest()
+            if seq == self.published and not force:
+                return False
+
+            for address in state:
+                n = self.poly.getNode(address)
+                if n is None:
+                    continue
+                self.publisher.begin(n)
+                try:
+                    for (driver, (value, uom)) in state[address].items():
+                        self.publisher.set(n, driver, value, uom, force)
+                finally:
+                    self.publisher.flush(n)
+
+            self.published = seq
+        self._log_stats()
+        return True
+
+    def collect_all(self, address, units, force, refresh=False):
+        # Query current conditions, precipitation summary and forecasts
+        # with a single batched request.
+        if not self.configured:
+            LOGGER.info('Skipping connection because we aren\'t configured yet.')
+            return
+
+        wmap = weather_map(units)
+        sites = self._sites(address)
+        extras = ['observations', 'observations/summary', 'forecasts']
+        data = self._fetch([(extra, site.location) for site in sites for extra in extras], refresh, force)
+        for site in sites:
+            site_data = self._site_data(site, data)
+            self._parse_conditions(site, wmap, site_data, force)
+            self._parse_forecasts(site, wmap, site_data, force)
+        self.results.commit()
+
+    def collect_conditions(self, address, units, force, refresh=False):
         # Query for the current conditions. We can do this fairly
         # frequently, probably as often as once a minute.
 
@@ -282,16 +845,110 @@ class queries(object):
             LOGGER.info('Skipping connection because we aren\'t configured yet.')
             return
 
-        precipitation = 0
-        wmap = WeatherData(units)
-        n = self.poly.getNode(address)
+        # only the locations that should have a new observation by now
+        sites = [site for site in self._sites(address) if force or refresh or site.scheduler.due('observations')]
+        if len(sites) == 0:
+            LOGGER.debug('Skipping observations request, no new observation expected yet. {}'.format(self._schedule_stats()))
+            return
+
+        wmap = weather_map(units)
+        extras = ['observations', 'observations/summary']
+        data = self._fetch([(extra, site.location) for site in sites for extra in extras], refresh, force)
+        for site in sites:
+            site_data = self._site_data(site, data)
+            self._parse_conditions(site, wmap, site_data, force)
+        self.results.commit()
+
+    # The responses for one site, by endpoint
+    def _site_data(self, site, data):
+        return {extra: jdata for ((extra, location), jdata) in data.items() if location == site.location}
+
+    """
+    Identify a response, by the observation time for observations and
+    by a hash of the content for the other endpoints.  None if the
+    response has no data.
+    """
+    def _fingerprint(self, extra, jdata):
+        try:
+            if extra == 'observations':
+                return int(jdata['response']['ob']['timestamp'])
+            return hashlib.sha1(json.dumps(jdata['response'], sort_keys=True).encode()).hexdigest()
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    # True if the response is different from the last one we published
+    # for the site (for the same units) or force is set.
+    def _changed(self, site, extra, jdata, wmap, force):
+        fingerprint = self._fingerprint(extra, jdata)
+        key = (extra, site.index, site.location)
+        if not force and fingerprint is not None and self.fingerprints.get(key) == (wmap, fingerprint):
+            self.fingerprint_hits += 1
+            return False
+
+        self.fingerprint_misses += 1
+        return True
+
+    # Remember the response once it's been parsed, so a failed update is
+    # tried again with the same data.
+    def _parsed(self, site, extra, jdata, wmap):
+        fingerprint = self._fingerprint(extra, jdata)
+        if fingerprint is not None:
+            self.fingerprints[(extra, site.index, site.location)] = (wmap, fingerprint)
+
+    # Let the schedulers know what a request returned, the observation
+    # time for observations and a hash of the content for forecasts.
+    def _update_schedule(self, extra, location, jdata):
+        if extra not in schedule.MAX_AGE:
+            return
+        version = self._fingerprint(extra, jdata)
+        if version is None:
+            return
+        for site in self._sites_at(location):
+            if extra == 'observations':
+                site.scheduler.update(extra, version, version)
+            else:
+                site.scheduler.update(extra, version)
+
+    def _sites_at(self, location):
+        return [site for site in self.sites if site.location == location]
+
+    # Scheduler counts for all the sites
+    def _schedule_stats(self):
+        stats = {'issued': 0, 'skipped': 0}
+        for site in self.sites:
+            for (key, value) in site.scheduler.stats().items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def _log_stats(self):
+        total = self.fingerprint_hits + self.fingerprint_misses
+        LOGGER.debug('Driver updates: {} unchanged responses: {}/{} scheduled requests: {}'.format(self.publisher.stats(), self.fingerprint_hits, total, self._schedule_stats()))
+
+    # Parse the current condition drivers from the observations and
+    # precipitation summary into the results.  Parsing is skipped for a
+    # response that hasn't changed.
+    def _parse_conditions(self, site, wmap, data, force):
+        if self._changed(site, 'observations', data['observations'], wmap, force):
+            if self._update_conditions(site, wmap, data['observations'], force):
+                self._parsed(site, 'observations', data['observations'], wmap)
+        else:
+            LOGGER.debug('Observations for {} unchanged, skipping update'.format(site.location))
+
+        if self._changed(site, 'observations/summary', data['observations/summary'], wmap, force):
+            if self._update_precipitation(site, wmap, data['observations/summary'], force):
+                self._parsed(site, 'observations/summary', data['observations/summary'], wmap)
+
+    def _update_conditions(self, site, wmap, jdata, force):
+        n = self.poly.getNode(site.address)
+        if n is None:
+            # node failed to be created
+            return False
         prec = 1  ## TODO: this may need to go in wmap too or can we pull this from editor?
 
         try:
-            jdata = self._get_weather_data('observations')
             if jdata == None:
                 LOGGER.error('Current condition query returned no data')
-                return
+                return False
             '''
             Data from query has multiple units. Which one we want to use depends
             on what the user has selected.  Since we set the node to metric by
@@ -301,15 +958,15 @@ class queries(object):
             #jdata['response']['ob']['tempC']
             if 'response' not in jdata:
                 LOGGER.error('No response object in query response.')
-                return
+                return False
 
             if 'ob' not in jdata['response']:
                 LOGGER.error('No observation object in query response.')
-                return
+                return False
 
             if 'loc' in jdata['response']:
                 if 'lat' in jdata['response']['loc']:
-                    self.latitude = float(jdata['response']['loc']['lat'])
+                    site.latitude = float(jdata['response']['loc']['lat'])
                 else:
                     LOGGER.error('No latitude data in response.')
             else:
@@ -317,38 +974,114 @@ class queries(object):
 
             ob = jdata['response']['ob']
 
-            for drv in n.drivers:
-                if drv['driver'] == 'PRECIP':
-                    continue # this comes from a different query
-                if drv['driver'] == 'ST':
-                    continue # Skip this
-
+            # only the drivers whose fields this location provides
+            for (driver, tag, uom, convert) in self.schema.filter('observations', (site.index, site.location), wmap.table(n.drivers, False, prec), ob):
+                value = ob.get(tag, MISSING)
+                if value is MISSING:
+                    continue
                 try:
-                    v = wmap.parse(drv['driver'], ob)
-                    if v == None or v == "None":
-                        v = "0"
-                    if drv['driver'] == 'GV15' and wmap.isMetric:
-                        v = v * 10 # snow depth is in cm, convert to mm
-                    n.setDriver(drv['driver'], round(float(v), prec), True, force, wmap.uom(drv['driver']))
-                    LOGGER.debug('setDriver (%s, %f)' %(drv['driver'], float(v)))
+                    v = convert(value)
+                    self.results.set(n, driver, v, uom, force)
+                    LOGGER.debug('setDriver (%s, %f)', driver, v)
                 except Exception as e:
-                    LOGGER.warning('Error updating {}: {}'.format(drv['driver'], e))
+                    LOGGER.warning('Error updating {}: {}'.format(driver, e))
+
+            self._update_observed_eto(site, n, wmap, ob, force)
+            self._update_history(site, n, wmap, ob, force)
+            return True
 
         except Exception as e:
             LOGGER.error('Current observation update failure: {}'.format(e))
+            return False
+
+    """
+    Add the observation to the rolling history and publish the pressure
+    trend and 24 hour high/low temperature and maximum gust.
+    """
+    def _update_history(self, site, n, wmap, ob, force):
+        try:
+            timestamp = int(ob['timestamp'])
+            temp = float(ob[wmap['CLITEMP']['tag']])
+            pressure = float(ob[wmap['BARPRES']['tag']])
+            gust = float(ob[wmap['GUST']['tag']] or 0)
+        except (KeyError, TypeError, ValueError) as e:
+            LOGGER.debug('Observation missing data for history: {}'.format(e))
+            return
+
+        site.history.add(timestamp, temp, pressure, gust)
+
+        # steady is less than 1 mb (0.03 inHg) change over 3 hours
+        steady = 0.03 if wmap.uom('BARPRES') == 23 else 1.0
+        change = site.history.pressure_change()
+        if change > steady:
+            trend = 2   # rising
+        elif change < -steady:
+            trend = 0   # falling
+        else:
+            trend = 1   # steady
+
+        self.results.set(n, 'GV3', trend, 25, force)
+        self.results.set(n, 'GV4', round(site.history.temp_high(), 1), wmap.uom('CLITEMP'), force)
+        self.results.set(n, 'GV5', round(site.history.temp_low(), 1), wmap.uom('CLITEMP'), force)
+        self.results.set(n, 'GV6', round(site.history.gust_high(), 1), wmap.uom('GUST'), force)
+
+    """
+    Add the observation to today's running totals and publish the ETo
+    so far today.  Temperature needs to be in C and wind speed in m/s.
+    """
+    def _update_observed_eto(self, site, n, wmap, ob, force):
+        try:
+            temp = float(ob[wmap['CLITEMP']['tag']])
+            humidity = float(ob[wmap['CLIHUM']['tag']])
+            wind = float(ob[wmap['SPEED']['tag']] or 0)
+            solar = ob.get(wmap['SOLRAD']['tag'])
+            timestamp = int(ob['timestamp'])
+        except (KeyError, TypeError, ValueError) as e:
+            LOGGER.debug('Observation missing data for ETo: {}'.format(e))
+            return
+
+        if wmap.uom('CLITEMP') == 17:
+            temp = et3.FtoC(temp)
+        if wmap.uom('SPEED') == 48:
+            wind = et3.mph2ms(wind)
+        else:
+            wind = et3.kph2ms(wind)
+        if solar is not None:
+            solar = float(solar)
+
+        # the location's UTC offset, so the day starts at its midnight
+        try:
+            offset = datetime.datetime.fromisoformat(ob['dateTimeISO']).utcoffset().total_seconds()
+        except (KeyError, TypeError, ValueError, AttributeError):
+            offset = None
+
+        site.observed.add(timestamp, temp, humidity, wind, solar, offset)
+        eto = site.observed.eto(site.latitude, float(site.elevation), float(self.plant_type))
+        if eto is None:
+            return
+
+        if wmap.uom('ETO') == 120:
+            eto = round(et3.mm2inch(eto), 3)
+        else:
+            eto = round(eto, 2)
+        self.results.set(n, 'ETO', eto, wmap.uom('ETO'), force)
 
+    def _update_precipitation(self, site, wmap, jdata, force):
         """ 
         We get precipitation from a different query. 
         """
+        n = self.poly.getNode(site.address)
+        if n is None:
+            return False
+
         try:
             # Get precipitation summary
-            jdata = self._get_weather_data('observations/summary')
             if jdata == None:
                 LOGGER.error('Precipitation summary query returned no data')
-                return
+                return False
             if 'response' not in jdata:
                 LOGGER.error('No response object in query response.')
-                return
+                return False
 
             #LOGGER.debug(jdata)
 
@@ -359,76 +1092,151 @@ class queries(object):
 
             if 'precip' in rd:
                 if 'precip_summary' in rd['precip']:
-                    LOGGER.debug('precipitation info: ' + str(rd['precip'][self.tag['precip_summary']]))
+                    LOGGER.debug('precipitation info: ' + str(rd['precip']['precip_summary']))
                     v = wmap.parse('PRECIP', rd['precip']['precip_summary'])
                     if v == None or v == "None":
                         v = "0"
-                    n.setDriver('PRECIP', round(float(v), 2), True, force, wmap.uom('PRECIP'))
+                    self.results.set(n, 'PRECIP', round(float(v), 2), wmap.uom('PRECIP'), force)
                 else:
                     LOGGER.debug('Setting precipitation to: ' + str(rd['precip']))
                     v = wmap.parse('PRECIP', rd['precip'])
                     if v == None or v == "None":
                         v = "0"
-                    n.setDriver('PRECIP', round(float(v), 2), True, force, wmap.uom('PRECIP'))
+                    self.results.set(n, 'PRECIP', round(float(v), 2), wmap.uom('PRECIP'), force)
             else:
-                n.setDriver('PRECIP', 0, True, force, wmap.uom('PRECIP'))
+                self.results.set(n, 'PRECIP', 0, wmap.uom('PRECIP'), force)
+            return True
                 
         except Exception as e:
             LOGGER.error('Precipitation summary update failure: {}'.format(e))
+            return False
             #update('PRECIP', precipitation)
                 
 
     # is forecast days a parameter here or a class variable set at __init__?
-    def query_forecasts(self, units, force):
+    def collect_forecasts(self, units, force, refresh=False):
         if not self.configured:
             LOGGER.info('Skipping connection because we aren\'t configured yet.')
             return
 
-        wmap = WeatherData(units)
+        sites = [site for site in self._sites() if force or refresh or site.scheduler.due('forecasts')]
+        if len(sites) == 0:
+            LOGGER.debug('Skipping forecasts request, forecast not expected to change yet. {}'.format(self._schedule_stats()))
+            return
+
+        wmap = weather_map(units)
+        data = self._fetch([('forecasts', site.location) for site in sites], refresh, force)
+        for site in sites:
+            site_data = self._site_data(site, data)
+            self._parse_forecasts(site, wmap, site_data, force)
+        self.results.commit()
+
+    def _parse_forecasts(self, site, wmap, data, force):
+        if not self._changed(site, 'forecasts', data['forecasts'], wmap, force):
+            LOGGER.debug('Forecasts for {} unchanged, skipping update'.format(site.location))
+            return
+        if self._update_forecasts(site, wmap, data['forecasts'], force):
+            self._parsed(site, 'forecasts', data['forecasts'], wmap)
+
+    # True if every forecast node was updated
+    def _update_forecasts(self, site, wmap, jdata, force):
         prec = 1
+        updated = False
         try:
-            jdata = self._get_weather_data('forecasts')
             if jdata == None:
-                LOGGER.error('Current condition query returned no data')
-                return
+                LOGGER.error('Forecast query returned no data')
+                return False
 
             # Records are for each day, midnight to midnight
-            day = 0
             if 'periods' in jdata['response'][0]:
-                LOGGER.debug('Processing periods: %d' % len(jdata['response'][0]['periods']))
-                for forecast in jdata['response'][0]['periods']:
-                    address = 'forecast_' + str(day)
+                periods = jdata['response'][0]['periods'][:int(self.days)]
+                LOGGER.debug('Processing periods: %d' % len(periods))
+                eto = self._forecast_eto(site, wmap, periods)
+                updated = True
+                for day in range(0, len(periods)):
+                    forecast = periods[day]
+                    address = site.forecast_address(day)
                     LOGGER.debug(' >>>>   period ' + forecast['dateTimeISO'] + '  ' + address)
                     epoch = int(forecast['timestamp'])
                     n = self.poly.getNode(address)
-                    for drv in n.drivers:
-                        if drv['driver'] == 'ETO':  # etO, calculated value
-                            continue
-
-                        if drv['driver'] == 'GV19':  # day of week
-                            dow = time.strftime("%w", time.gmtime(epoch))
-                            n.setDriver(drv['driver'], dow, True, force, wmap.uom(drv['driver']))
-                            continue
-
-                        try:
-                            v = wmap.fparse(drv['driver'], forecast)
-                            if v == None or v == "None":
-                                v = "0"
-                            if drv['driver'] == 'GV15' and wmap.isMetric:
-                                v = v * 10 # snow depth is in cm, convert to mm
-                            n.setDriver(drv['driver'], round(float(v), prec), True, force, wmap.uom(drv['driver']))
-                            LOGGER.debug('setDriver (%s, %f)' %(drv['driver'], float(v)))
-                        except Exception as e:
-                            LOGGER.warning('Error updating {}: {}'.format(drv['driver'], e))
-
-                    n.max_humidity = float(forecast['maxHumidity'])
-                    n.min_humidity = float(forecast['minHumidity'])
-                    n.set_ETo(epoch, self.latitude, force)
-                    #n.update_forecast(forecast, self.latitude, self.tag, force)
-                    day += 1
-                    if day >= int(self.days):
-                        return
+                    if n is None:
+                        # node failed to be created
+                        updated = False
+                        continue
+
+                    self._update_forecast_day(site, n, wmap, forecast, epoch, eto[day], prec, force)
 
         except Exception as e:
             LOGGER.error('Forecast data failure: {}'.format(e))
+            return False
+        return updated
+
+    # The solar terms for the site, only rebuilt if its location
+    # (latitude or elevation) changes.
+    def _solar_table(self, site):
+        if site.solar_table is None or not site.solar_table.matches(site.latitude, float(site.elevation)):
+            LOGGER.debug('Building solar table for latitude {}'.format(site.latitude))
+            site.solar_table = et3.SolarTable(site.latitude, float(site.elevation))
+        return site.solar_table
+
+    """
+    Calculate ETo for all the forecast days in one call.  Temperature
+    needs to be in C and wind speed in m/s.  The result is converted
+    to the ETo driver's units (mm/day or inches/day).
+    """
+    def _forecast_eto(self, site, wmap, periods):
+        try:
+            max_t = []
+            min_t = []
+            ws = []
+            max_h = []
+            min_h = []
+            days = []
+            for forecast in periods:
+                max_t.append(float(forecast[wmap['GV0']['ftag']]))
+                min_t.append(float(forecast[wmap['GV1']['ftag']]))
+                ws.append(float(forecast[wmap['SPEED']['ftag']]))
+                max_h.append(float(forecast['maxHumidity']))
+                min_h.append(float(forecast['minHumidity']))
+                days.append(datetime.datetime.fromtimestamp(int(forecast['timestamp'])).timetuple().tm_yday)
+
+            if wmap.uom('GV0') == 17:
+                max_t = [et3.FtoC(t) for t in max_t]
+                min_t = [et3.FtoC(t) for t in min_t]
+            if wmap.uom('SPEED') == 48:
+                ws = [et3.mph2ms(w) for w in ws]
+            else:
+                ws = [et3.kph2ms(w) for w in ws]
+
+            eto = et3.evapotranspiration_batch(max_t, min_t, ws, max_h, min_h, days, site.latitude, float(site.elevation), float(self.plant_type), table=self._solar_table(site))
+        except Exception as e:
+            LOGGER.error('ETo calculation failed: {}'.format(e))
+            return [None] * len(periods)
+
+        # ETo is in mm/day. If the user wants imperial or uk units, it needs to be converted.
+        if wmap.uom('ETO') == 120:
+            eto = [round(et3.mm2inch(e), 3) for e in eto]
+        else:
+            eto = [round(e, 2) for e in eto]
+        LOGGER.info('ETo = {}'.format(eto))
+        return eto
+
+    def _update_forecast_day(self, site, n, wmap, forecast, epoch, et0, prec, force):
+        # day of week
+        dow = time.strftime("%w", time.gmtime(epoch))
+        self.results.set(n, 'GV19', dow, wmap.uom('GV19'), force)
+
+        for (driver, tag, uom, convert) in self.schema.filter('forecasts', (site.index, site.location), wmap.table(n.drivers, True, prec), forecast):
+            value = forecast.get(tag, MISSING)
+            if value is MISSING:
+                continue
+            try:
+                v = convert(value)
+                self.results.set(n, driver, v, uom, force)
+                LOGGER.debug('setDriver (%s, %f)', driver, v)
+            except Exception as e:
+                LOGGER.warning('Error updating {}: {}'.format(driver, e))
+
+        if et0 is not None:
+            self.results.set(n, 'ETO', et0, wmap.uom('ETO'), force)
 
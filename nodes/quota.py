@@ -0,0 +1,124 @@
+"""
+Limit AERIS requests to the plan's per minute and per day access caps.
+
+The limits are token buckets kept in a state file shared by all the node
+servers on this host that use the same client ID, so they share one
+budget.  The file is locked while it's updated.
+
+Observation requests can use the whole budget, forecast requests have
+to leave some of it for observations.  Forced queries (QUERY command,
+startup) also have their own per minute limit so a burst of them can't
+use up the budget.
+"""
+import os
+import time
+import json
+import hashlib
+import tempfile
+import threading
+import udi_interface
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOGGER = udi_interface.LOGGER
+
+HIGH = 0   # observations
+LOW = 1    # forecasts
+
+# Part of the budget low priority requests can't use
+RESERVE = 0.25
+
+class Quota(object):
+    def __init__(self, client_id='', per_minute=0, per_day=0, forced_per_minute=2, path=None):
+        self.lock = threading.Lock()
+        self.granted = 0
+        self.denied = 0
+        self.configure(client_id, per_minute, per_day, forced_per_minute, path)
+
+    def configure(self, client_id, per_minute, per_day, forced_per_minute=2, path=None):
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.forced_per_minute = forced_per_minute
+        if path is None:
+            digest = hashlib.sha1(client_id.encode()).hexdigest()[:12]
+            path = os.path.join(tempfile.gettempdir(), 'aeris_quota_' + digest + '.json')
+        self.path = path
+
+    # (name, capacity, seconds to refill) for the buckets the request uses
+    def _buckets(self, forced):
+        buckets = []
+        if self.per_minute > 0:
+            buckets.append(('minute', self.per_minute, 60))
+        if self.per_day > 0:
+            buckets.append(('day', self.per_day, 86400))
+        if forced and self.forced_per_minute > 0 and len(buckets) > 0:
+            buckets.append(('forced', self.forced_per_minute, 60))
+        return buckets
+
+    def _refill(self, state, name, capacity, period, now):
+        tokens, stamp = state.get(name, (capacity, now))
+        tokens = min(capacity, tokens + (now - stamp) * capacity / period)
+        state[name] = (tokens, now)
+        return tokens
+
+    def _cost(self, name, cost):
+        return 1 if name == 'forced' else cost
+
+    # Take cost tokens from every bucket, or none if any of them is short.
+    # The forced bucket counts queries, not the endpoints in them.
+    def acquire(self, cost=1, priority=HIGH, forced=False):
+        buckets = self._buckets(forced)
+        if len(buckets) == 0:
+            return True
+
+        with self.lock:
+            try:
+                with open(self.path, 'a+') as f:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_EX)
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or '{}')
+                    except ValueError:
+                        state = {}
+
+                    now = time.time()
+                    allowed = True
+                    for (name, capacity, period) in buckets:
+                        tokens = self._refill(state, name, capacity, period, now)
+                        reserve = capacity * RESERVE if priority == LOW and name != 'forced' else 0
+                        if tokens - self._cost(name, cost) < reserve:
+                            allowed = False
+
+                    if allowed:
+                        for (name, capacity, period) in buckets:
+                            state[name] = (state[name][0] - self._cost(name, cost), now)
+
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+            except (IOError, OSError) as e:
+                # don't stop polling because the state file is unusable
+                LOGGER.error('Failed to update quota state {}: {}'.format(self.path, e))
+                return True
+
+        if allowed:
+            self.granted += 1
+        else:
+            self.denied += 1
+        return allowed
+
+    # The most requests a single acquire() can ever be granted at the
+    # priority, None if there's no limit.
+    def max_cost(self, priority=HIGH):
+        sizes = []
+        for (name, capacity, period) in self._buckets(False):
+            sizes.append(capacity * (1 - RESERVE) if priority == LOW else capacity)
+        if len(sizes) == 0:
+            return None
+        return max(1, int(min(sizes)))
+
+    def stats(self):
+        return {'granted': self.granted, 'denied': self.denied}
@@ -0,0 +1,99 @@
+"""
+Skip polls that can't return new data.
+
+AERIS station observations are only updated every 10 to 60 minutes and
+the forecasts a few times a day, but we poll every shortPoll/longPoll.
+The scheduler learns how often each endpoint's data changes (from the
+observation timestamp, or the time the forecast content changed) and
+how long an update takes to show up, and a poll is only due once the
+next update is expected.  If the data doesn't
+change at the expected time we keep polling every time until it does.
+
+No matter what was learned, a request is made at least every max_age
+seconds.
+"""
+import time
+from collections import deque
+
+# Longest time, in seconds, to go without requesting an endpoint
+MAX_AGE = {
+        'observations': 1800,
+        'forecasts': 10800,
+        }
+DEFAULT_MAX_AGE = 1800
+
+class Endpoint(object):
+    def __init__(self, max_age, samples):
+        self.max_age = max_age
+        self.version = None
+        self.changed = 0
+        self.fetched = 0
+        self.intervals = deque(maxlen=samples)
+        self.delays = deque(maxlen=samples)
+
+    # Typical time between updates, None until we've seen one
+    def interval(self):
+        if len(self.intervals) == 0:
+            return None
+        ordered = sorted(self.intervals)
+        return min(ordered[len(ordered) // 2], self.max_age)
+
+    # Shortest time seen between an update being issued and it showing
+    # up in a response.
+    def delay(self):
+        return min(self.delays) if len(self.delays) > 0 else 0
+
+class Scheduler(object):
+    def __init__(self, max_age=None, samples=5):
+        self.max_age = dict(MAX_AGE)
+        if max_age is not None:
+            self.max_age.update(max_age)
+        self.samples = samples
+        self.endpoints = {}
+        self.issued = 0
+        self.skipped = 0
+
+    def _endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = Endpoint(self.max_age.get(name, DEFAULT_MAX_AGE), self.samples)
+        return self.endpoints[name]
+
+    # True if a request for the endpoint could return new data
+    def due(self, name):
+        e = self._endpoint(name)
+        now = time.time()
+        interval = e.interval()
+
+        if interval is None or now - e.fetched >= e.max_age or now >= e.changed + interval + e.delay():
+            return True
+
+        self.skipped += 1
+        return False
+
+    # Count a request actually sent for the endpoint
+    def requested(self, name):
+        self.issued += 1
+
+    # Record the data an AERIS request returned for the endpoint (not
+    # cached or last good data).  version identifies the
+    # data (observation time or a hash of the content) and updated is
+    # when it was issued, if known.
+    def update(self, name, version, updated=None):
+        e = self._endpoint(name)
+        now = time.time()
+        e.fetched = now
+
+        if version == e.version:
+            return False
+
+        if updated is None:
+            updated = now
+        if e.version is not None and updated > e.changed:
+            e.intervals.append(updated - e.changed)
+            e.delays.append(max(now - updated, 0))
+        e.version = version
+        e.changed = updated
+        return True
+
+    def stats(self):
+        return {'issued': self.issued, 'skipped': self.skipped}
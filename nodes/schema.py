@@ -0,0 +1,38 @@
+"""
+Learn which fields a location's responses actually have.
+
+Not every location provides every field, a PWS station often has no
+solar radiation, UV or snow depth for example.  Rather than look up
+(and fail on) every missing field on every poll, the driver table for an
+endpoint is filtered down to the fields that are in the response.  The
+filtered table is re-checked every recheck seconds in case fields show
+up (or go away) later.
+"""
+import time
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+class Schema(object):
+    def __init__(self, recheck=21600):
+        self.recheck = recheck
+        self.tables = {}
+
+    # Return the entries of table, (driver, tag, uom, convert), whose tag
+    # is in record.
+    def filter(self, extra, location, table, record):
+        key = (extra, location, id(table))
+        entry = self.tables.get(key)
+        now = time.time()
+        if entry is not None and now < entry[0]:
+            return entry[1]
+
+        present = tuple(t for t in table if t[1] in record)
+        if len(present) < len(table):
+            missing = [t[1] for t in table if t[1] not in record]
+            LOGGER.info('{} response has no {}, those drivers will not be updated'.format(extra, ', '.join(missing)))
+        self.tables[key] = (now + self.recheck, present)
+        return present
+
+    def clear(self):
+        self.tables.clear()
@@ -0,0 +1,67 @@
+"""
+Persist the last published driver values so they can be shown right
+away when the node server restarts, before the first AERIS request
+completes.
+
+The values are kept in a small SQLite database, one row per node and
+driver with the time it was saved.
+"""
+import sqlite3
+import json
+import time
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+class Snapshot(object):
+    def __init__(self, path='aeris_state.db'):
+        self.path = path
+        try:
+            with self._connect() as db:
+                db.execute('CREATE TABLE IF NOT EXISTS drivers (address TEXT, driver TEXT, value TEXT, uom INTEGER, updated REAL, PRIMARY KEY (address, driver))')
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to open state database {}: {}'.format(path, e))
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    # Save the current driver values for the nodes
+    def save(self, nodes):
+        now = time.time()
+        rows = []
+        for node in nodes:
+            if node is None:
+                continue
+            for d in node.drivers:
+                if d['driver'] == 'ST':
+                    continue
+                rows.append((node.address, d['driver'], json.dumps(d['value']), d['uom'], now))
+
+        try:
+            db = self._connect()
+            with db:
+                db.executemany('INSERT OR REPLACE INTO drivers VALUES (?, ?, ?, ?, ?)', rows)
+            db.close()
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to save state: {}'.format(e))
+
+    # Return the saved drivers for a node as a list of (driver, value, uom, updated)
+    def load(self, address):
+        try:
+            db = self._connect()
+            rows = db.execute('SELECT driver, value, uom, updated FROM drivers WHERE address = ?', (address,)).fetchall()
+            db.close()
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to load state: {}'.format(e))
+            return []
+
+        return [(driver, json.loads(value), uom, updated) for (driver, value, uom, updated) in rows]
+
+    def forget(self, address):
+        try:
+            db = self._connect()
+            with db:
+                db.execute('DELETE FROM drivers WHERE address = ?', (address,))
+            db.close()
+        except sqlite3.Error as e:
+            LOGGER.error('Failed to remove state for {}: {}'.format(address, e))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the AERIS API that serves canned responses.
+
+Serves the observations, observations/summary, forecasts and batch
+endpoints with fixed data so the node server can be exercised without
+using any API quota.  Locations containing INVALID get an
+invalid_location error.
+
+usage:
+    python3 tools/fake_aeris.py [port]
+    AERIS_API=http://localhost:8080/ python3 aeris.py
+"""
+
+import sys
+import time
+import json
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+START = int(time.time())
+
+def observation():
+    return {
+        'id': 'PWS_FAKE',
+        'loc': {'long': -122.25, 'lat': 37.25},
+        'place': {'name': 'fake', 'state': 'ca', 'country': 'us'},
+        'ob': {
+            'timestamp': START, 'dateTimeISO': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(START)),
+            'tempC': 18.3, 'tempF': 65,
+            'dewpointC': 9.4, 'dewpointF': 49,
+            'humidity': 56,
+            'pressureMB': 1016, 'pressureIN': 30.0,
+            'windDirDEG': 270,
+            'windSpeedKPH': 11, 'windSpeedMPH': 7,
+            'windGustKPH': 20, 'windGustMPH': 12,
+            'visibilityKM': 16.09, 'visibilityMI': 10,
+            'weatherCoded': '::FW',
+            'heatindexC': 18, 'heatindexF': 65,
+            'windchillC': 18, 'windchillF': 65,
+            'feelslikeC': 18, 'feelslikeF': 65,
+            'sky': 20,
+            'solradWM2': 450,
+            'uvi': 4,
+            'snowDepthCM': 0, 'snowDepthIN': 0,
+            },
+        }
+
+def summary():
+    return [{
+        'id': 'PWS_FAKE',
+        'periods': [{'summary': {'precip': {'totalMM': 1.2, 'totalIN': 0.05}}}],
+        }]
+
+def forecasts(limit):
+    periods = []
+    for day in range(limit):
+        ts = START + day * 86400
+        periods.append({
+            'timestamp': ts,
+            'dateTimeISO': time.strftime('%Y-%m-%dT00:00:00', time.gmtime(ts)),
+            'maxTempC': 24, 'maxTempF': 75,
+            'minTempC': 11, 'minTempF': 52,
+            'tempC': 18, 'tempF': 64,
+            'maxHumidity': 91, 'minHumidity': 36, 'humidity': 60,
+            'pressureMB': 1015, 'pressureIN': 29.97,
+            'windDirDEG': 250,
+            'windSpeedKPH': 13, 'windSpeedMPH': 8,
+            'windSpeedMaxKPH': 24, 'windSpeedMaxMPH': 15,
+            'windSpeedMinKPH': 3, 'windSpeedMinMPH': 2,
+            'windGustKPH': 30, 'windGustMPH': 19,
+            'precipMM': 0, 'precipIN': 0,
+            'snowCM': 0, 'snowIN': 0,
+            'pop': 10,
+            'sky': 35,
+            'uvi': 6,
+            'weatherPrimaryCoded': 'C:L:R',
+            'solradWM2': 5200,
+            })
+    return [{'loc': {'long': -122.25, 'lat': 37.25}, 'interval': 'day', 'periods': periods}]
+
+# Copy the value at a dotted field path (e.g. periods.maxTempF) from
+# src to dst, applying it to each entry of any lists along the way.
+def pick(src, parts, dst):
+    if isinstance(src, list):
+        for i, item in enumerate(src):
+            if len(dst) <= i:
+                dst.append({})
+            pick(item, parts, dst[i])
+        return
+
+    if not isinstance(src, dict) or parts[0] not in src:
+        return
+
+    if len(parts) == 1:
+        dst[parts[0]] = src[parts[0]]
+    else:
+        if parts[0] not in dst:
+            dst[parts[0]] = [] if isinstance(src[parts[0]], list) else {}
+        pick(src[parts[0]], parts[1:], dst[parts[0]])
+
+def filter_fields(response, fields):
+    out = [] if isinstance(response, list) else {}
+    for f in fields.split(','):
+        pick(response, f.split('.'), out)
+    return out
+
+def endpoint_response(path, query):
+    # any location with INVALID in it is rejected, like a mistyped one
+    if 'INVALID' in path:
+        return {'success': False, 'error': {'code': 'invalid_location', 'description': 'The requested location was not found.'}, 'response': []}
+
+    if path.startswith('/observations/summary'):
+        response = summary()
+    elif path.startswith('/observations'):
+        response = observation()
+    elif path.startswith('/forecasts'):
+        limit = int(query.get('limit', ['7'])[0] or 7)
+        response = forecasts(limit)
+    else:
+        return {'success': False, 'error': {'code': 'invalid_endpoint', 'description': path}, 'response': []}
+
+    if 'fields' in query:
+        response = filter_fields(response, query['fields'][0])
+
+    return {'success': True, 'error': None, 'response': response}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # allow keep-alive connections
+    requests_served = 0
+
+    def do_GET(self):
+        Handler.requests_served += 1
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path.startswith('/batch'):
+            responses = []
+            for r in query.get('requests', [''])[0].split(','):
+                sub = urllib.parse.urlparse(urllib.parse.unquote(r))
+                jdata = endpoint_response(sub.path, urllib.parse.parse_qs(sub.query))
+                jdata['request'] = r
+                responses.append(jdata)
+            jdata = {'success': True, 'error': None, 'response': {'responses': responses}}
+        else:
+            jdata = endpoint_response(url.path, query)
+
+        body = json.dumps(jdata).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        sys.stderr.write('[{}] {}\n'.format(Handler.requests_served, format % args))
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    print('Fake AERIS API on http://localhost:{}/'.format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
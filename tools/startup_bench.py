@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Measure node server startup against a fake Polyglot interface.
+
+A minimal udi_interface module is installed in place of the real one so
+no Polyglot connection is needed.  It sends the custom parameters and
+acknowledges each added node after a short delay, the way Polyglot
+does.  The AERIS requests go to tools/fake_aeris.py, run in a thread.
+
+Reports the time to import the node server modules and the time from
+creating the controller until the first poll's data has been published,
+for a range of forecast days, and how long the poll and query handlers
+take after that.  Custom data is kept between runs like
+Polyglot does, so only the first run should send the profile.
+
+usage:
+    python3 tools/startup_bench.py [ack delay] [config delay] [AERIS response delay]
+
+(delays in seconds)
+"""
+
+import os
+import sys
+import copy
+import time
+import types
+import logging
+import shutil
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+ACK_DELAY = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+CONFIG_DELAY = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+API_DELAY = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+# Polyglot's saved custom data, by name
+STORE = {}
+
+
+class Node(object):
+    def __init__(self, poly, primary, address, name):
+        self.poly = poly
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.private = None
+        self.drivers = copy.deepcopy(self.drivers)
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None, text=None):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                changed = d['value'] != value or (uom is not None and d['uom'] != uom)
+                d['value'] = value
+                if uom is not None:
+                    d['uom'] = uom
+                if report and (changed or force):
+                    self.reportDriver(driver, force)
+                return changed
+
+    def getDriver(self, driver):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                return d['value']
+
+    def reportDriver(self, driver, force):
+        self.poly.send({'set': [{'address': self.address, 'driver': driver}]}, 'status')
+
+
+class Custom(dict):
+    def __init__(self, poly, name):
+        super(Custom, self).__init__()
+        self.name = name
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        super(Custom, self).__setitem__(key, value)
+        STORE.setdefault(self.name, {})[key] = value
+
+    def load(self, data):
+        self.update(data)
+
+    def isChanged(self, key):
+        return False
+
+
+class Interface(object):
+    CONFIG = 'config'
+    CUSTOMPARAMS = 'customparams'
+    CUSTOMDATA = 'customdata'
+    CONFIGDONE = 'configdone'
+    START = 'start'
+    POLL = 'poll'
+    ADDNODEDONE = 'addnodedone'
+
+    def __init__(self, params):
+        self.params = params
+        self.nodes = {}
+        self.handlers = {}
+        self.messages = 0
+        self.profile_updates = 0
+
+    def subscribe(self, topic, handler, address=None):
+        self.handlers[topic] = handler
+
+    def _later(self, delay, topic, *data):
+        def send():
+            time.sleep(delay)
+            if topic in self.handlers:
+                self.handlers[topic](*data)
+        threading.Thread(target=send, daemon=True).start()
+
+    def ready(self):
+        if self.CUSTOMDATA in self.handlers:
+            self.handlers[self.CUSTOMDATA](dict(STORE.get('customdata', {})))
+        self._later(CONFIG_DELAY, self.CUSTOMPARAMS, self.params)
+        self._later(CONFIG_DELAY, self.CONFIGDONE)
+
+    def addNode(self, node, conn_status=None, rename=False):
+        self.nodes[node.address] = node
+        self._later(ACK_DELAY, self.ADDNODEDONE, {'address': node.address})
+        return node
+
+    def getNode(self, address):
+        return self.nodes.get(address)
+
+    def getNodes(self):
+        return self.nodes
+
+    def delNode(self, address):
+        self.nodes.pop(address, None)
+
+    def send(self, message, kind):
+        self.messages += 1
+
+    def updateProfile(self):
+        self.profile_updates += 1
+
+    def setCustomParamsDoc(self):
+        pass
+
+
+def install_fake_interface():
+    module = types.ModuleType('udi_interface')
+    module.LOGGER = logging.getLogger('bench')
+    module.Node = Node
+    module.Custom = Custom
+    module.Interface = Interface
+    sys.modules['udi_interface'] = module
+
+
+def run(days):
+    from nodes import aeris
+
+    params = {
+        'ClientID': 'x' * 21,
+        'ClientSecret': 'y' * 40,
+        'Location': 'PWS_FAKE',
+        'Units': 'metric',
+        'Forecast Days': str(days),
+        'Elevation': '100',
+        'Plant Type': '0.23',
+        }
+    poly = Interface(params)
+
+    start = time.time()
+    controller = aeris.Controller(poly, 'controller', 'controller', 'AERIS Weather')
+    controller.start()
+    elapsed = time.time() - start
+
+    # as if the cached responses had expired
+    controller.q.cache.clear()
+    start = time.time()
+    controller.poll('shortPoll')
+    controller.query()
+    handlers = (time.time() - start) / 2
+    controller.stop()
+    return elapsed, handlers, poly.messages, poly.profile_updates
+
+
+if __name__ == '__main__':
+    install_fake_interface()
+    logging.getLogger('bench').addHandler(logging.NullHandler())
+    logging.getLogger('bench').propagate = False
+
+    import fake_aeris
+    server = ThreadingHTTPServer(('localhost', 0), fake_aeris.Handler)
+    fake_aeris.Handler.log_message = lambda *args: None
+    do_GET = fake_aeris.Handler.do_GET
+    def slow_GET(handler):
+        time.sleep(API_DELAY)
+        do_GET(handler)
+    fake_aeris.Handler.do_GET = slow_GET
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['AERIS_API'] = 'http://localhost:{}/'.format(server.server_address[1])
+
+    # keep the saved state out of the source tree
+    work = tempfile.mkdtemp()
+    shutil.copytree(os.path.join(ROOT, 'profile'), os.path.join(work, 'profile'))
+    shutil.copy(os.path.join(ROOT, 'POLYGLOT_CONFIG.md'), work)
+    os.chdir(work)
+
+    start = time.time()
+    from nodes import aeris
+    print('node server modules imported in {:.3f}s'.format(time.time() - start))
+
+    print('node ack delay {}s, configuration delay {}s, AERIS delay {}s'.format(ACK_DELAY, CONFIG_DELAY, API_DELAY))
+    for days in (0, 3, 7, 12):
+        elapsed, handlers, messages, updates = run(days)
+        print('{:2d} forecast days: first poll published after {:.3f}s, poll/query handlers {:.1f}ms ({} messages, {} profile updates)'.format(days, elapsed, handlers * 1000, messages, updates))
+
+    server.shutdown()